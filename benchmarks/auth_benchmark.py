@@ -0,0 +1,86 @@
+'''
+Measures what authentication costs per request, before and after the token caches:
+
+  uncached: jwt.decode + principal query on every request (what get_current_user used to do)
+  cached:   verified token cache + principal cache (e_commerce_api.tokens, user_router.principal_cache)
+
+and what it costs to get a new access token:
+
+  password: /token, one bcrypt check at BCRYPT_ROUNDS
+  refresh:  /token/refresh, a refresh token rotation
+
+Usage: python benchmarks/auth_benchmark.py [requests]
+'''
+
+import asyncio
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.security import OAuth2PasswordRequestForm
+from jose import jwt
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from e_commerce_api import models, passwords, tokens
+from e_commerce_api.routers import user_router
+from e_commerce_api.schemas.user_schema import RefreshRequest
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    # A file, the async endpoints (aiosqlite) and the sync ones each open their own connections to it
+    path = os.path.join(tempfile.mkdtemp(), 'auth.db')
+    engine = create_engine('sqlite:///' + path, connect_args={'check_same_thread': False})
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine, autoflush=False)()
+    async_db = async_sessionmaker(create_async_engine('sqlite+aiosqlite:///' + path), autoflush=False, expire_on_commit=False)()
+
+    user = models.User(email='buyer@example.com', username='buyer', password=passwords.hash_password('password'))
+    db.add(user)
+    db.commit()
+    db.add(models.Cart(user_id=user.id))
+    db.commit()
+
+    token = tokens.create_access_token({'sub': user.email})
+
+    loop = asyncio.new_event_loop()
+
+    def uncached():
+        payload = jwt.decode(token, tokens.SECRET_KEY, algorithms=[tokens.ALGORITHM])
+        return loop.run_until_complete(user_router.load_principal(async_db, payload['sub']))
+
+    def cached():
+        return loop.run_until_complete(user_router.get_current_user(token, async_db))
+
+    assert uncached() == cached()
+
+    for name, path in [('uncached', uncached), ('cached', cached)]:
+        best = min(timeit.repeat(path, number=requests, repeat=3))
+        print(f'{name:>8}: {best / requests * 1e6:8.1f} us per request')
+
+    form = OAuth2PasswordRequestForm(username='buyer', password='password')
+    state = {'refresh_token': loop.run_until_complete(user_router.login_for_access_token(form, async_db))['refresh_token']}
+
+    def password():
+        return loop.run_until_complete(user_router.login_for_access_token(form, async_db))
+
+    def refresh():
+        state['refresh_token'] = user_router.refresh_access_token(RefreshRequest(refresh_token=state['refresh_token']), db)['refresh_token']
+
+    logins = 20
+    for name, path in [('password', password), ('refresh', refresh)]:
+        best = min(timeit.repeat(path, number=logins, repeat=3))
+        print(f'{name:>8}: {best / logins * 1e3:8.2f} ms per new access token')
+
+    loop.run_until_complete(async_db.close())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Mixed read/write throughput of the database engine under each connection profile.
+
+  rollback journal: SQLite as created by default (journal_mode=DELETE, synchronous=FULL),
+                    a writer blocks every reader of the file
+  wal:              SQLite with database.SQLITE_PRAGMAS (WAL, synchronous=NORMAL, busy_timeout,
+                    mmap_size, cache_size, foreign_keys)
+  server:           the database_url given on the command line, with the DB_POOL_* settings
+
+Every worker thread loops on its own session for a few seconds: a search page
+(filter_router.search_page, in-stock products in a price range) most of the time, an order
+of one unit (ordering.place_order) otherwise. Each SQLite profile gets a new temporary file.
+
+Usage: python benchmarks/database_profile_benchmark.py [workers] [write ratio] [seconds] [database_url]
+'''
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from e_commerce_api import database, models
+from e_commerce_api.ordering import place_order
+from e_commerce_api.routers.filter_router import ProductFilters, search_page
+
+PRODUCTS = 2_000
+
+
+def seed(Session) -> int:
+    db = Session()
+    user = models.User(email=f'buyer-{time.time_ns()}@example.com', password='-')
+    db.add(user)
+    db.flush()
+    db.execute(insert(models.Product), [
+        {'title': f'Product {i}', 'description': 'Fresh from the farm', 'price': 1 + i % 100, 'quantity_available': 1_000_000,
+         'category': 'fruits', 'owner_id': user.id}
+        for i in range(PRODUCTS)
+    ])
+    db.commit()
+    user_id = user.id
+    db.close()
+    return user_id
+
+
+def run(engine, workers: int, write_ratio: float, seconds: float):
+    Session = sessionmaker(bind=engine, autoflush=False)
+    user_id = seed(Session)
+    product_ids = [i for (i,) in Session().query(models.Product.id).filter(models.Product.owner_id == user_id).all()]
+
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        db = Session()
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    if rng.random() < write_ratio:
+                        place_order(db, user_id, {rng.choice(product_ids): 1})
+                        db.commit()
+                        outcome = 'writes'
+                    else:
+                        low = rng.randint(1, 90)
+                        search_page(db, ProductFilters(keyword=None, category_id=None, min_price=low, max_price=low + 10, owner_id=None, in_stock=True))
+                        db.rollback()
+                        outcome = 'reads'
+                except (OperationalError, HTTPException):
+                    db.rollback()
+                    outcome = 'errors'
+                with lock:
+                    counts[outcome] += 1
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+    return counts['reads'] / elapsed, counts['writes'] / elapsed, counts['errors']
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    write_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    url = sys.argv[4] if len(sys.argv) > 4 else None
+
+    def sqlite_file():
+        return 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'profile.db')
+
+    profiles = [
+        # pysqlite's own 5 s busy timeout, as before the pragmas
+        ('rollback journal', lambda: database.make_engine(sqlite_file(), sqlite_pragmas={}, pool_size=workers)),
+        ('wal', lambda: database.make_engine(sqlite_file(), pool_size=workers)),
+    ]
+    if url != None:
+        profiles.append(('server', lambda: database.make_engine(url)))
+
+    print(f'{workers} workers, {write_ratio:.0%} writes, {seconds:g} s per profile')
+    for name, make_engine in profiles:
+        engine = make_engine()
+        models.Base.metadata.create_all(bind=engine)
+        reads, writes, errors = run(engine, workers, write_ratio, seconds)
+        print(f'{name:>16}: {reads:8.0f} reads/s  {writes:7.0f} writes/s  {errors:5d} errors (locked / timed out)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+Drives the hot endpoints with many concurrent clients, async against threadpool.
+
+  threadpool: the endpoints as served, plain def endpoints on a Session, which Starlette
+              runs on its threadpool (40 threads)
+  async:      the same queries (search_page, read_order_page) in async def endpoints, run
+              with run_sync on an AsyncSession (aiosqlite / asyncpg)
+
+Scenarios: a keyword search page (GET /products/?keyword=) and the current user's
+order history (GET /order-self, token check included). Every client sends its
+requests one after another, all the clients at once. Requests go through httpx's ASGI
+transport, so this measures the app and the database but not the network.
+
+Runs against a temporary SQLite file by default, pass a database URL to run against
+another database (the tables are created, the rows it adds are left behind). SQLite
+answers in microseconds; the gap grows with the database round trip, measure against
+the database used in production.
+
+Usage: python benchmarks/load_benchmark.py [clients] [requests per client] [database_url]
+'''
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+# Read by e_commerce_api.database when it is imported: the endpoints' write and read sessions all use this database,
+# both pools with enough connections for every client (the threadpool and the event loop are what is compared)
+os.environ['DATABASE_URL'] = sys.argv[3] if len(sys.argv) > 3 else 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load.db')
+os.environ['DB_POOL_SIZE'] = str(CLIENTS)
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from e_commerce_api import database, models, search, tokens
+from e_commerce_api.routers import filter_router, order_router, user_router
+from e_commerce_api.routers.user_router import get_current_active_user
+from e_commerce_api.schemas.filter_schema import SearchProductResponse
+from e_commerce_api.schemas.order_schema import OrderDetails
+from e_commerce_api.serialization import SerializedJSONResponse, dump_list
+
+PRODUCTS = 5_000
+ORDERS = 200
+
+
+def seed(Session) -> str:
+    db = Session()
+    buyer = models.User(email=f'buyer-{time.time_ns()}@example.com', password='-')
+    db.add(buyer)
+    db.flush()
+    db.execute(insert(models.Product), [
+        {'title': f'{"Apples" if i % 10 == 0 else "Pears"} {i}', 'description': 'Fresh from the farm', 'price': 1 + i % 50,
+         'quantity_available': 100, 'category': 'fruits', 'owner_id': buyer.id}
+        for i in range(PRODUCTS)
+    ])
+    for i in range(ORDERS):
+        order = models.Orders(user_id=buyer.id, order_date=datetime.now(), order_quantity=1, total_price=1)
+        db.add(order)
+        db.flush()
+        db.add(models.OrderItem(order_id=order.id, product_id=1 + i % PRODUCTS, quantity=1, price=1, total_price=1))
+    db.commit()
+    email = buyer.email
+    db.close()
+    return tokens.create_access_token({'sub': email})
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(filter_router.router_search_filter)
+    app.include_router(order_router.router_order)
+
+    # The async twins, same queries run with run_sync on an AsyncSession in an async def endpoint
+    @app.get('/async/products/')
+    async def search_async(filters: filter_router.ProductFilters = Depends(), db: AsyncSession = Depends(database.get_async_read_db)):
+        rows, _ = await db.run_sync(filter_router.search_page, filters)
+        return SerializedJSONResponse(dump_list(SearchProductResponse, rows))
+
+    @app.get('/async/order-self')
+    async def orders_async(current_user=Depends(get_current_active_user), filters: order_router.OrderFilters = Depends(), db: AsyncSession = Depends(database.get_async_read_db)):
+        orders, _ = await db.run_sync(order_router.read_order_page, [models.Orders.user_id == current_user.id], order_router.USER_ORDERS_KEYS, filters, f'orders:{current_user.id}')
+        return SerializedJSONResponse(dump_list(OrderDetails, orders))
+
+    return app
+
+
+async def drive(app: FastAPI, path: str, headers: dict, clients: int, requests: int):
+    latencies = []
+
+    async def client(http: httpx.AsyncClient):
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = await http.get(path, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as http:
+        started = time.perf_counter()
+        await asyncio.gather(*[client(http) for _ in range(clients)])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    clients, requests = CLIENTS, REQUESTS
+
+    models.Base.metadata.create_all(bind=database.engine)
+    search.create_search_index(database.engine)
+
+    token = seed(database.SessionLocal)
+    headers = {'Authorization': f'Bearer {token}'}
+
+    app = build_app()
+
+    async def run():
+        print(f'{clients} clients x {requests} requests')
+        for name, path in [('search', '/products/?keyword=apples'), ('orders', '/order-self')]:
+            for mode, prefix in [('threadpool', ''), ('async', '/async')]:
+                # One round to open the pooled connections, then cold caches (principal, verified tokens) for the measured run
+                await drive(app, prefix + path, headers, clients, 1)
+                user_router.principal_cache.clear()
+                tokens.verified_tokens.clear()
+                throughput, p50, p99 = await drive(app, prefix + path, headers, clients, requests)
+                print(f'{name:>7} {mode:>10}: {throughput:8.0f} req/s   p50 {p50 * 1e3:7.1f} ms   p99 {p99 * 1e3:7.1f} ms')
+        await database.async_engine.dispose()
+
+    # One event loop for every run, pooled asyncio connections belong to the loop that opened them
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+Hammers one product with concurrent orders and checks that it is never oversold.
+
+Every buyer thread places orders of one unit through e_commerce_api.ordering, each in its
+own session and transaction, until the stock runs out. At the end the units sold (order
+items written) must equal the stock taken, and the stock must not be negative.
+
+Runs against a temporary SQLite file by default, pass a database URL to run against another
+database (the tables are created, the products, users and orders it adds are left behind).
+
+Usage: python benchmarks/order_oversell_check.py [buyers] [stock] [database_url]
+'''
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from e_commerce_api import models
+from e_commerce_api.ordering import place_order
+
+
+def main():
+    buyers = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    url = sys.argv[3] if len(sys.argv) > 3 else 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'oversell.db')
+
+    engine = create_engine(url, pool_size=buyers, connect_args={'timeout': 30} if url.startswith('sqlite') else {})
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    db = Session()
+    user = models.User(email=f'buyer-{time.time_ns()}@example.com', password='-')
+    db.add(user)
+    db.flush()
+    product = models.Product(title='Contended', description='One SKU everybody wants', price=1, quantity_available=stock,
+                             category='fruits', owner_id=user.id)
+    db.add(product)
+    db.commit()
+    user_id, product_id = user.id, product.id
+    db.close()
+
+    counts = {'placed': 0, 'refused': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def buyer():
+        db = Session()
+        try:
+            while True:
+                try:
+                    place_order(db, user_id, {product_id: 1})
+                    db.commit()
+                    outcome = 'placed'
+                except HTTPException:
+                    outcome = 'refused'
+                except OperationalError:
+                    db.rollback()
+                    outcome = 'errors'
+                with lock:
+                    counts[outcome] += 1
+                if outcome == 'refused':
+                    return
+        finally:
+            db.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=buyer) for _ in range(buyers)]
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+    elapsed = time.perf_counter() - started
+
+    db = Session()
+    left = db.query(models.Product.quantity_available).filter(models.Product.id == product_id).scalar()
+    sold = db.query(func.coalesce(func.sum(models.OrderItem.quantity), 0)).filter(models.OrderItem.product_id == product_id).scalar()
+    db.close()
+
+    print(f'{buyers} buyers, {counts["placed"]} orders placed in {elapsed:.2f} s, {counts["refused"]} refused (out of stock), {counts["errors"]} lock errors')
+    print(f'stock {stock}, sold {sold}, left {left}')
+
+    assert left >= 0, 'stock went negative'
+    assert sold + left == stock, 'units sold do not match the stock taken'
+    assert sold == counts['placed'], 'orders placed do not match the units sold'
+    print('no oversell')
+
+
+if __name__ == '__main__':
+    main()
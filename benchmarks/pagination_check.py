@@ -0,0 +1,93 @@
+'''
+Walks every page of product search for each sort criteria and checks that no product is missing or repeated.
+
+The products share their sort values in groups (same title, price and created_at), so a page
+often ends in the middle of a group and the next one has to continue on the id. Some groups
+have no title (NULL), which sorts apart from every value. Part of them
+are stored the way older databases hold them (created_at without microseconds, as SQLite's
+CURRENT_TIMESTAMP writes it) and brought to the current format with
+`python manage.py normalize-product-timestamps`, like an existing database would be.
+
+Usage: python benchmarks/pagination_check.py [products] [page size]
+'''
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read by e_commerce_api when it is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'pages.db')
+
+from fastapi.testclient import TestClient
+
+import manage
+from e_commerce_api import database, models
+from e_commerce_api.routers.filter_router import SortCriteria
+from main import create_app
+
+GROUP_SIZE = 4
+
+
+def seed(products: int):
+    db = database.SessionLocal()
+    seller = models.User(email='seller@example.com', username='seller', password='-', is_seller=True)
+    db.add(seller)
+    db.flush()
+
+    # Every GROUP_SIZE products share a title, a price and a creation time, every third group has no title
+    started = datetime(2024, 1, 29, 12, 21, 20)
+    values = [{'title': f'Product {i // GROUP_SIZE}' if i // GROUP_SIZE % 3 != 1 else None, 'description': 'Paged', 'price': 1 + i // GROUP_SIZE, 'quantity_available': 10,
+               'category': 'fruits', 'owner_id': seller.id, 'created_at': started + timedelta(seconds=i // GROUP_SIZE)} for i in range(products)]
+    legacy, current = values[:products // 2], values[products // 2:]
+
+    db.add_all([models.Product(**i, last_edited=i['created_at']) for i in current])
+    db.commit()
+    with database.engine.begin() as connection:
+        for i in legacy:
+            stamp = i['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+            connection.exec_driver_sql(
+                'INSERT INTO products (title, description, price, quantity_available, quantity_reserved, category, owner_id, created_at, last_edited) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)',
+                (i['title'], i['description'], i['price'], i['quantity_available'], i['category'], i['owner_id'], stamp, stamp))
+    db.close()
+
+
+def walk(client: TestClient, sort_by, limit: int, products: int) -> list:
+    # The ids of every page in order, gives up once more pages were read than there can be
+    ids, cursor = [], None
+    for _ in range(products // limit + 2):
+        params = {'limit': limit, **({'sort_by': sort_by.value} if sort_by != None else {}), **({'cursor': cursor} if cursor != None else {})}
+        response = client.get('/products/', params=params)
+        assert response.status_code == 200, f'{response.status_code} {response.text}'
+        ids.extend(i['id'] for i in response.json())
+        cursor = response.headers.get('x-next-cursor')
+        if cursor == None:
+            break
+    return ids
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+
+    models.Base.metadata.create_all(bind=database.engine)
+    seed(products)
+    manage.normalize_product_timestamps(None)
+    client = TestClient(create_app())
+
+    failed = False
+    for sort_by in [None, *SortCriteria]:
+        ids = walk(client, sort_by, limit, products)
+        ok = len(ids) == len(set(ids)) == products
+        failed = failed or not ok
+        name = sort_by.value if sort_by != None else 'id'
+        print(f'{name:>10}: {len(ids)} ids, {len(set(ids))} unique, {products} products  {"ok" if ok else "FAIL"}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
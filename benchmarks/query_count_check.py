@@ -0,0 +1,129 @@
+'''
+Checks the number of SQL statements each endpoint runs, and that it does not grow with the rows.
+
+Every scenario runs twice, on a few rows and on many (cart lines, order lines, products of a
+seller): a query per row (N+1) shows as a count that grows. The counts come from the
+X-Query-Count header of the app built with DEBUG_QUERIES=1, the X-Query-Repeated header
+lists the statement shapes run several times. The budget of a scenario is its most queries
+for any number of rows, the exit status is 1 when a scenario is over it or grows.
+
+The same budgets can be asserted in tests with e_commerce_api.query_counter.assert_max_queries.
+
+Usage: python benchmarks/query_count_check.py [few rows] [many rows]
+'''
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read by e_commerce_api when it is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'queries.db')
+os.environ['DEBUG_QUERIES'] = '1'
+
+from fastapi.testclient import TestClient
+
+from e_commerce_api import database, models, search, tokens
+from e_commerce_api.query_counter import count_queries
+from main import create_app
+
+# Most statements per request, whatever the number of rows (the token check included)
+BUDGETS = {
+    'add to cart': 4,
+    'read cart': 1,
+    'place order': 9,
+    'order history': 3,
+    'read order': 1,
+    'search': 1,
+    'list products': 1,
+    'delete buyer': 9,
+    'delete seller': 14,
+}
+
+
+def seed(db, rows: int, run: int) -> dict:
+    # A seller with rows products, a buyer with a cart line for each of them, a second seller and buyer (with the same cart) to delete
+    users = {name: models.User(email=f'{name}-{run}@example.com', username=f'{name}-{run}', password='-', is_seller=name.endswith('seller'))
+             for name in ('seller', 'buyer', 'leaving-seller', 'leaving-buyer')}
+    db.add_all(users.values())
+    db.flush()
+    warehouses = {name: models.Warehouse(user_id=users[name].id) for name in ('seller', 'leaving-seller')}
+    carts = {name: models.Cart(user_id=users[name].id) for name in ('buyer', 'leaving-buyer')}
+    db.add_all([*warehouses.values(), *carts.values()])
+    db.flush()
+    for name in ('seller', 'leaving-seller'):
+        products = [models.Product(title=f'Apples {run}-{i}', description='Fresh from the farm', price=1, quantity_available=1_000,
+                                   category='fruits', owner_id=users[name].id) for i in range(rows)]
+        db.add_all(products)
+        db.flush()
+        db.add_all([models.WarehouseItem(warehouse_id=warehouses[name].id, product_id=i.id) for i in products])
+        if name == 'seller':
+            db.add_all([models.CartItem(cart_id=carts[buyer].id, product_id=i.id, quantity=1) for buyer in ('buyer', 'leaving-buyer') for i in products])
+            product_ids = [i.id for i in products]
+    db.commit()
+    search.rebuild_search_index(db)
+    db.commit()
+
+    headers = {name: {'Authorization': 'Bearer ' + tokens.create_access_token({'sub': i.email})} for name, i in users.items()}
+    return {'headers': headers, 'cart_id': carts['buyer'].id, 'product_ids': product_ids, 'keyword': f'apples {run}'}
+
+
+def scenarios(client: TestClient, data: dict):
+    # (name, request) in order, each request building on the previous ones
+    headers, product_ids = data['headers'], data['product_ids']
+    cart = f'/cart/{data["cart_id"]}'
+    yield 'add to cart', lambda: client.post('/cart', headers=headers['buyer'], json={'cart_id': data['cart_id'], 'product_id': product_ids[-1], 'quantity': 1})
+    yield 'read cart', lambda: client.get(cart, headers=headers['buyer'])
+    yield 'place order', lambda: client.post('/orders', headers=headers['buyer'], json={'products': [{'product_id': i, 'quantity': 1} for i in product_ids]})
+    yield 'order history', lambda: client.get('/order-self', headers=headers['buyer'])
+    yield 'read order', lambda: client.get(f'/orders/{client.get("/order-self", headers=headers["buyer"]).json()[0]["id"]}', headers=headers['buyer'])
+    yield 'search', lambda: client.get('/products/', params={'keyword': data['keyword']})
+    yield 'list products', lambda: client.get('/products')
+    yield 'delete buyer', lambda: client.delete('/users/profile', headers=headers['leaving-buyer'])
+    yield 'delete seller', lambda: client.delete('/users/profile', headers=headers['leaving-seller'])
+
+
+def measure(client: TestClient, rows: int, run: int) -> dict:
+    db = database.SessionLocal()
+    data = seed(db, rows, run)
+    db.close()
+
+    counts = {}
+    for name, request in scenarios(client, data):
+        with count_queries() as stats:
+            response = request()
+        assert response.status_code < 300, f'{name}: {response.status_code} {response.text}'
+        counts[name] = (int(response.headers['x-query-count']), response.headers.get('x-query-repeated'))
+        # The request's own count (header) against everything run during the block, the same unless a lambda sends two requests
+        assert counts[name][0] <= stats.count, f'{name}: {counts[name][0]} queries in the header, {stats.count} run'
+    return counts
+
+
+def main():
+    few = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    many = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    models.Base.metadata.create_all(bind=database.engine)
+    search.create_search_index(database.engine)
+    with database.engine.begin() as connection:
+        connection.execute(models.Categories.__table__.insert().values(category='fruits'))
+    client = TestClient(create_app())
+
+    small, large = measure(client, few, 1), measure(client, many, 2)
+
+    failed = False
+    print(f'{"scenario":>14} {few:>5} rows {many:>5} rows  budget')
+    for name, budget in BUDGETS.items():
+        (n_small, _), (n_large, repeated) = small[name], large[name]
+        ok = n_small == n_large and n_large <= budget
+        failed = failed or not ok
+        print(f'{name:>14} {n_small:10d} {n_large:10d} {budget:7d}  {"ok" if ok else "FAIL"}')
+        if repeated != None:
+            print(f'{"":>14} repeated: {repeated}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Checks that reads and writes go to the right database, with a primary and two read replicas.
+
+The three databases are SQLite files. The replicas start as copies of the primary and are
+never updated afterwards, so a row written after the copy shows which database a request
+read from. It checks that:
+
+  - writes land on the primary only
+  - the read-only endpoints (search, catalog export, all orders) read from the replicas, in turn
+  - the buyer who just placed an order sees it in their history (read from the primary, as
+    told by the cookie the order sets), and their history goes back to the replicas after
+    READ_YOUR_WRITES_SECONDS
+
+Pass three database URLs to run against databases that replicate for real (e.g. a Postgres
+primary and two streaming replicas; the tables are created and the rows it adds are left
+behind): the replicas then catch up, so only the writes and the read-your-writes case are checked.
+
+Usage: python benchmarks/replica_routing_check.py [primary_url replica_url replica_url]
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+directory = tempfile.mkdtemp()
+# The replicas are frozen copies of the primary (SQLite files), or replicate for real
+COPIES = len(sys.argv) <= 3
+if not COPIES:
+    primary_url, replica_urls = sys.argv[1], sys.argv[2:4]
+else:
+    primary_url = 'sqlite:///' + os.path.join(directory, 'primary.db')
+    replica_urls = ['sqlite:///' + os.path.join(directory, f'replica-{i}.db') for i in (1, 2)]
+
+# Read by e_commerce_api.database when it is imported
+os.environ['DATABASE_URL'] = primary_url
+os.environ['DATABASE_REPLICA_URLS'] = ','.join(replica_urls)
+os.environ['READ_YOUR_WRITES_SECONDS'] = '1'
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.engine import make_url
+
+from e_commerce_api import database, models, search, tokens
+from e_commerce_api.routers import filter_router, order_router, product_router
+
+
+def seed() -> dict:
+    # The primary and then its copies: a seller with one product, two buyers with one order each
+    models.Base.metadata.create_all(bind=database.engine)
+    search.create_search_index(database.engine)
+    db = database.SessionLocal()
+    seller = models.User(email='seller@example.com', username='seller', password='-', is_seller=True)
+    buyers = [models.User(email=f'buyer{i}@example.com', username=f'buyer{i}', password='-') for i in (1, 2)]
+    db.add_all([models.Categories(category='fruits'), seller, *buyers])
+    db.flush()
+    db.add_all([models.Warehouse(user_id=seller.id), *[models.Cart(user_id=i.id) for i in buyers]])
+    db.add(models.Product(title='Apples', description='Juicy apples', price=1, quantity_available=100, category='fruits', owner_id=seller.id))
+    db.flush()
+    for i in buyers:
+        db.add(models.Orders(user_id=i.id, order_date=datetime.now(), order_quantity=1, total_price=1))
+    db.commit()
+    search.rebuild_search_index(db)
+    db.commit()
+    db.close()
+    # Closing the last connection checkpoints the WAL into the file, the copies then have every row
+    database.engine.dispose()
+
+    if COPIES:
+        for url in replica_urls:
+            shutil.copy(make_url(primary_url).database, make_url(url).database)
+
+    return {name: {'Authorization': 'Bearer ' + tokens.create_access_token({'sub': f'{name}@example.com'})} for name in ('seller', 'buyer1', 'buyer2')}
+
+
+def main():
+    headers = seed()
+
+    app = FastAPI()
+    for router in [product_router.router_product, filter_router.router_search_filter, order_router.router_order]:
+        app.include_router(router)
+    client = TestClient(app)
+
+    # A write goes to the primary, the replicas do not have the new product
+    response = client.post('/products', headers=headers['seller'],
+                           json={'title': 'Pears', 'description': 'Juicy pears', 'price': 2, 'quantity_available': 10, 'category': 'fruits', 'owner_id': 1})
+    assert response.status_code in (200, 201), response.text
+    db = database.SessionLocal()
+    assert db.query(models.Product).filter(models.Product.title == 'Pears').count() == 1, 'the write did not reach the primary'
+    db.close()
+
+    print('writes go to the primary')
+
+    if COPIES:
+        titles = [[i['title'] for i in client.get('/products/?keyword=pears').json()] for _ in range(4)]
+        assert titles == [[]] * 4, f'search read from the primary: {titles}'
+        print('search reads from the replicas')
+
+        exported = [[i for i in client.get('/products/export').text.splitlines() if 'Pears' in i] for _ in range(2)]
+        assert exported == [[]] * 2, f'the export read from the primary: {exported}'
+        print('the catalog export reads from the replicas')
+
+        # Round robin: give each replica an extra order of its own, all orders then alternates between 3 and 4 orders
+        for n, replica in enumerate(database.read_router.replicas):
+            with replica.engine.begin() as connection:
+                for _ in range(n + 1):
+                    connection.execute(models.Orders.__table__.insert().values(user_id=1, order_date=datetime.now(), order_quantity=1, total_price=1))
+        counts = [len(client.get('/order').json()) for _ in range(4)]
+        assert sorted(set(counts)) == [3, 4] and counts[0] != counts[1] and counts[0] == counts[2], f'replicas not used in turn: {counts}'
+        print(f'all orders read from the replicas in turn: {counts}')
+
+    # Read your writes: buyer1 sees the order they placed at once, buyer2 still reads from a replica
+    response = client.post('/orders', headers=headers['buyer1'], json={'products': [{'product_id': 1, 'quantity': 1}]})
+    assert response.json()['detail'] == 'Order Placed Successfully', response.text
+    assert len(client.get('/order-self', headers=headers['buyer1']).json()) == 2, 'the order just placed is missing from the history'
+    # Another worker process knows nothing of the order, only the client's cookie tells it to read from the primary
+    other_worker = TestClient(app, cookies=dict(client.cookies))
+    assert len(other_worker.get('/order-self', headers=headers['buyer1']).json()) == 2, 'the read-your-writes cookie was not honoured'
+    if COPIES:
+        assert len(client.get('/order-self', headers=headers['buyer2']).json()) == 1
+        time.sleep(1.2)
+        assert len(client.get('/order-self', headers=headers['buyer1']).json()) == 1, 'the history did not go back to the replicas'
+    print('a buyer reads their own orders from the primary right after placing one')
+
+    print('routing ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Checks that every combination of search filters and sort criteria is answered from an index.
+
+Each combination of the ProductFilters (category, price range, seller, in stock, keyword) is
+searched with each sort criteria (and the default order), for its first page and for the page
+after a cursor. The SELECTs the search runs are captured and explained with EXPLAIN QUERY PLAN:
+a step reading the products table without an index (SCAN products, not SCAN products USING
+INDEX) is a full table scan, and the exit status is 1. The one exception is the default order
+(by id), where SCAN products walks the primary key in page order.
+
+Runs against a temporary SQLite file.
+
+Usage: python benchmarks/search_plan_check.py [products]
+'''
+
+import itertools
+import os
+import re
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+
+from e_commerce_api import database, models, search
+from e_commerce_api.routers.filter_router import SORT_KEYS, ProductFilters, search_page
+
+# Values of each filter when it is used
+FILTERS = {'keyword': 'apples', 'category_id': 1, 'min_price': 5, 'max_price': 50, 'owner_id': 1, 'in_stock': True}
+
+SELLERS = 20
+CATEGORIES = ['fruits', 'vegetables', 'dairy', 'meat', 'seafood', 'beverages', 'snacks', 'canned', 'frozen', 'baking']
+
+FULL_SCAN = re.compile(r'\bSCAN products\b(?! USING)')
+
+
+def _reads_whole_table(plan, ordered_by_id: bool) -> bool:
+    # SQLite reports the walk of the integer primary key as a plain SCAN too: in id order (the default order without a
+    # keyword) and without a sort step it reads the rows in page order and stops at the page size, like an index walk
+    if ordered_by_id and not any('USE TEMP B-TREE FOR ORDER BY' in i for i in plan):
+        return False
+    return any(FULL_SCAN.search(i) for i in plan)
+
+
+def seed(db, products: int):
+    # A catalog spread over sellers, categories, prices and stock, so that each filter keeps only part of it
+    sellers = [models.User(email=f'seller-{i}@example.com', username=f'seller-{i}', password='-', is_seller=True) for i in range(SELLERS)]
+    db.add_all([*[models.Categories(category=i) for i in CATEGORIES], *sellers])
+    db.flush()
+    db.add_all([models.Product(title=f'{("Apples", "Pears", "Plums")[i % 3]} {i}', description='Fresh from the farm', price=1 + i * 7 % 100,
+                               quantity_available=i % 3, category=CATEGORIES[i % len(CATEGORIES)], owner_id=sellers[i % SELLERS].id)
+                for i in range(products)])
+    db.commit()
+    search.rebuild_search_index(db)
+    db.commit()
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    engine = database.make_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'plans.db'))
+    models.Base.metadata.create_all(bind=engine)
+    search.create_search_index(engine)
+    db = database.SessionLocal(bind=engine)
+    seed(db, products)
+
+    statements = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'products' in statement:
+            statements.append((statement, parameters))
+
+    failed = False
+    checked = 0
+    for size in range(len(FILTERS) + 1):
+        for names in itertools.combinations(FILTERS, size):
+            filters = ProductFilters(**{name: FILTERS.get(name) if name in names else default for name, default in
+                                        [('keyword', None), ('category_id', None), ('min_price', None), ('max_price', None), ('owner_id', None), ('in_stock', False)]})
+            for sort_by in [None, *SORT_KEYS]:
+                statements.clear()
+                _, cursor = search_page(db, filters, sort_by, limit=2)
+                if cursor != None:
+                    search_page(db, filters, sort_by, cursor, limit=2)
+
+                for statement, parameters in list(statements):
+                    plan = [row[-1] for row in db.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+                    checked += 1
+                    if _reads_whole_table(plan, ordered_by_id=sort_by == None and filters.keyword == None):
+                        failed = True
+                        print(f'FAIL filters={list(names)} sort={sort_by.value if sort_by != None else "default"}')
+                        print('     ' + '\n     '.join(plan))
+
+    db.close()
+    print(f'{checked} search queries explained, {"a full scan of products was found" if failed else "every one uses an index"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
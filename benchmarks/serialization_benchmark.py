@@ -0,0 +1,55 @@
+'''
+Compares the two ways of building a list response for 10k products:
+
+  orm:  ORM instances -> one response model per row -> jsonable_encoder -> json.dumps (what FastAPI does for a returned list)
+  fast: column tuples -> one TypeAdapter call -> JSON bytes (e_commerce_api.serialization)
+
+Usage: python benchmarks/serialization_benchmark.py [rows]
+'''
+
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from e_commerce_api import models
+from e_commerce_api.schemas.filter_schema import SearchProductResponse
+from e_commerce_api.serialization import columns_of, dump_list
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    engine = create_engine('sqlite://')
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+
+    db.add(models.User(id=1, email='seller@example.com', password='-', is_seller=True))
+    db.add_all([models.Product(title=f'Product {i}', description=f'Description of product {i}', price=i % 100 + 0.5, quantity_available=i % 50,
+                               category='fruits', owner_id=1, created_at=datetime.now(), last_edited=datetime.now()) for i in range(rows)])
+    db.commit()
+
+    def orm_path():
+        products = [SearchProductResponse.model_validate(i) for i in db.query(models.Product).all()]
+        db.expunge_all()
+        return json.dumps(jsonable_encoder(products)).encode()
+
+    def fast_path():
+        return dump_list(SearchProductResponse, db.query(*columns_of(SearchProductResponse, models.Product)).all())
+
+    assert json.loads(orm_path()) == json.loads(fast_path())
+
+    for name, path in [('orm', orm_path), ('fast', fast_path)]:
+        best = min(timeit.repeat(path, number=1, repeat=5))
+        print(f'{name:>5}: {best * 1000:8.1f} ms for {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Time from a fresh process to its first answered request, what a new worker costs when it is
+started, restarted or scaled out.
+
+Each run is a new Python process: it imports main (the app is built, nothing else), runs the
+app's lifespan startup (background workers) and answers GET /products/ through httpx's ASGI
+transport. The database is a temporary SQLite file prepared once by manage.py create-schema,
+the way a deployment prepares it before starting the workers. The median of the runs is
+checked against the budget per worker, the exit status is 1 when it is over.
+
+Usage: python benchmarks/startup_benchmark.py [runs] [budget in seconds]
+'''
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_BUDGET_SECONDS = 1.5
+
+# Run in the new process, prints the import time and the time to the first response
+WORKER = '''
+import asyncio, time
+import httpx
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def first_request():
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(app=main.app, base_url='http://startup') as http:
+            response = await http.get('/products/')
+            assert response.status_code == 200, response.text
+    return time.perf_counter()
+
+answered = asyncio.run(first_request())
+print(imported - started, answered - started)
+'''
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else STARTUP_BUDGET_SECONDS
+
+    environment = {**os.environ, 'DATABASE_URL': 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')}
+    subprocess.run([sys.executable, 'manage.py', 'create-schema'], cwd=ROOT, env=environment, check=True, capture_output=True)
+
+    imports, firsts = [], []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-W', 'ignore', '-c', WORKER], cwd=ROOT, env=environment, check=True, capture_output=True, text=True)
+        imported, answered = map(float, result.stdout.split())
+        imports.append(imported)
+        firsts.append(answered)
+
+    median = statistics.median(firsts)
+    print(f'{runs} runs: import main {statistics.median(imports) * 1e3:6.0f} ms   first response {median * 1e3:6.0f} ms (median)')
+    print(f'budget {budget * 1e3:.0f} ms per worker: {"ok" if median <= budget else "OVER"}')
+    sys.exit(0 if median <= budget else 1)
+
+
+if __name__ == '__main__':
+    main()
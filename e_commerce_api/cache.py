@@ -0,0 +1,157 @@
+'''
+cache.py is an in-process cache for catalog reads that rarely change.
+
+Entries expire after a TTL, the least recently used entries are evicted once the
+backend is full, and every entry carries tags ('category:*', 'product:12', ...)
+so that write endpoints can invalidate exactly the entries their change affects.
+
+Tags are invalidated by giving them a new version instead of tracking the keys
+stored under them: an entry remembers the version of each of its tags when it is
+stored and becomes a miss as soon as one of them moved on. That way a backend
+only needs get/set/delete, and another store (e.g. Redis) can be plugged in by
+subclassing CacheBackend.
+
+'''
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+MISSING = object()
+
+
+class CacheBackend:
+    '''Storage behind a Cache. get returns MISSING for absent or expired keys.'''
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    '''Per-process LRU storage with per-entry expiry.'''
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at != None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl if ttl != None else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Cache:
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: float = 60):
+        self.backend = backend if backend != None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _tag_versions(self, tags: Iterable[str]) -> Dict[str, str]:
+        versions = {}
+        for tag in tags:
+            version = self.backend.get('tag:' + tag)
+            if version is MISSING:
+                version = uuid.uuid4().hex
+                self.backend.set('tag:' + tag, version)
+            versions[tag] = version
+        return versions
+
+    def get(self, key: str) -> Any:
+        entry = self.backend.get('value:' + key)
+        if entry is not MISSING:
+            value, versions = entry
+            if all(self.backend.get('tag:' + tag) == version for tag, version in versions.items()):
+                self._count(hit=True)
+                return value
+        self._count(hit=False)
+        return MISSING
+
+    def set(self, key: str, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None) -> None:
+        self._store(key, value, self._tag_versions(tags), ttl)
+
+    def _store(self, key, value, versions, ttl):
+        self.backend.set('value:' + key, (value, versions), ttl if ttl != None else self.ttl)
+
+    def get_or_set(self, key: str, loader: Callable[[], Any], tags: Iterable[str] = (), ttl: Optional[float] = None) -> Any:
+        '''Returns the cached value for key, or loads, stores and returns it.'''
+
+        value = self.get(key)
+        if value is MISSING:
+            # Tag versions are read before loading, an invalidation that races with the load then makes the stored entry stale immediately
+            versions = self._tag_versions(tags)
+            value = loader()
+            self._store(key, value, versions, ttl)
+        return value
+
+    def invalidate(self, *tags: str) -> None:
+        for tag in tags:
+            self.backend.set('tag:' + tag, uuid.uuid4().hex)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+# Shared by the category and product endpoints
+catalog_cache = Cache(MemoryBackend(max_entries=1024), ttl=60)
+
+
+# Catalog entries depend on 'category:*' / 'product:*' (which rows exist) or 'category:{id}' / 'product:{id}' (one row's fields)
+
+def invalidate_category(*category_ids) -> None:
+    catalog_cache.invalidate('category:*', *[f'category:{i}' for i in category_ids])
+
+
+def invalidate_product(*product_ids) -> None:
+    catalog_cache.invalidate('product:*', *[f'product:{i}' for i in product_ids])
@@ -0,0 +1,70 @@
+'''
+conditional.py answers conditional GET requests for catalog endpoints.
+
+The validators (a strong ETag and, where the data has one, a Last-Modified date)
+are computed once when a representation is loaded and cached next to it, so a
+client whose copy is still current gets a 304 without the body being built,
+validated or serialized again.
+
+'''
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Optional
+
+from fastapi import Request, Response, status
+
+
+def make_etag(value: Any) -> str:
+    '''Strong ETag of a representation: serialized bytes, or any value with a stable repr (models, dicts, lists, dates, numbers...).'''
+    return '"' + hashlib.sha1(value if isinstance(value, bytes) else repr(value).encode()).hexdigest() + '"'
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Timestamps are stored naive in local time (datetime.now())
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [i.strip() for i in header.split(',')]
+    # If-None-Match uses the weak comparison, W/"x" matches "x"
+    return '*' in candidates or etag in [i[2:] if i.startswith('W/') else i for i in candidates]
+
+
+def _not_modified_since(header: str, last_modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo == None:
+        return False
+    return _as_utc(last_modified) <= since
+
+
+def conditional_response(request: Request, response: Response, etag: str, last_modified: Optional[datetime] = None) -> Optional[Response]:
+    '''
+    Sets the validators on response. Returns a 304 response to send instead of the body
+    when the client's copy is still current, None otherwise.
+    '''
+
+    headers = {'ETag': etag}
+    if last_modified != None:
+        headers['Last-Modified'] = format_datetime(_as_utc(last_modified), usegmt=True)
+
+    if_none_match = request.headers.get('if-none-match')
+    if_modified_since = request.headers.get('if-modified-since')
+
+    # If-Modified-Since is only looked at when there is no If-None-Match (RFC 9110 13.2.2)
+    if if_none_match != None:
+        not_modified = _etag_matches(if_none_match, etag)
+    elif if_modified_since != None and last_modified != None:
+        not_modified = _not_modified_since(if_modified_since, last_modified)
+    else:
+        not_modified = False
+
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return None
@@ -7,8 +7,8 @@ This file creates kind of a link between sqlalchemy and python
 from datetime import datetime
 import enum
 from typing import List
-from sqlalchemy import DECIMAL, TIMESTAMP, Boolean, Column, Enum, ForeignKey, Integer, String, Table, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import DECIMAL, JSON, TIMESTAMP, Boolean, Column, Date, Enum, ForeignKey, Index, Integer, String, Table, func
+from sqlalchemy.orm import column_property, relationship
 
 from .database import Base
 
@@ -40,6 +40,19 @@ class User(Base):
     chats = relationship("Connection", back_populates='user')
     
 
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    
+    id = Column(Integer, primary_key=True, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), index=True, nullable=False)
+    # Only a SHA-256 of the token is stored, the token itself is only ever known to the client
+    token_hash = Column(String, unique=True, nullable=False)
+    # UTC, like the exp claim of access tokens
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=datetime.utcnow)
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    revoked_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    
+
 class Product(Base):
     __tablename__ = "products"
 
@@ -48,12 +61,19 @@ class Product(Base):
     description = Column(String, index=True, nullable=False)
     price = Column(DECIMAL, nullable=False)
     quantity_available = Column(DECIMAL, nullable = True)
+    # Units held by carts (stock_holds), maintained by e_commerce_api/reservations.py
+    quantity_reserved = Column(DECIMAL, nullable=False, default=0, server_default='0')
     category = Column(String, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
+    # Stamped in Python rather than by the database: SQLite's CURRENT_TIMESTAMP has no microseconds, so those values would
+    # not compare equal to the same time bound back from a pagination cursor
     created_at = Column(TIMESTAMP(timezone=True),
-                       nullable=False, default=func.now())
+                       nullable=False, default=datetime.now)
     last_edited = Column(TIMESTAMP(timezone=True),
-                       nullable=False, default=func.now() )
+                       nullable=False, default=datetime.now)
+    
+    # What can still be sold or put in a cart
+    available_to_sell = column_property(quantity_available - quantity_reserved)
 
     # Foreign key relations
     order_products = relationship("OrderItem", back_populates='product')
@@ -61,6 +81,15 @@ class Product(Base):
     warehouse_items = relationship("WarehouseItem", back_populates='product')
     
     
+    # Back the ORDER BY of each search sort criteria and the search filters
+    __table_args__ = (
+        Index('ix_products_title_id', 'title', 'id'),
+        Index('ix_products_price_id', 'price', 'id'),
+        Index('ix_products_created_at_id', 'created_at', 'id'),
+        Index('ix_products_category_price', 'category', 'price', 'id'),
+        Index('ix_products_owner_id_created_at', 'owner_id', 'created_at', 'id'),
+    )
+    
     def __str__(self):
         return f"title: {self.title}\ndescription: {self.description}"
     
@@ -94,10 +123,34 @@ class CartItem(Base):
     cart = relationship("Cart", back_populates="cart_items")
     product = relationship("Product", back_populates="cart_items", uselist=False)
     
+    # One line per product, adding a product again adds to its line (an index rather than a constraint so that
+    # `python manage.py migrate-cart-items` can add it to an existing table once duplicates are merged)
+    __table_args__ = (
+        Index('uq_cart_items_cart_id_product_id', 'cart_id', 'product_id', unique=True),
+    )
+    
     def __str__(self):
         return f"id:{self.cart_id}\nuser_id:{self.product_id}"   
     
     
+# A cart line's claim on stock, released when it expires (or the line is ordered or removed)
+class StockHold(Base):
+    __tablename__ = "stock_holds"
+    
+    id = Column(Integer, primary_key=True, index=True, nullable=False)
+    cart_id = Column(Integer, ForeignKey("carts.id", ondelete='CASCADE'), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete='CASCADE'), nullable=False)
+    quantity = Column(DECIMAL, nullable=False)
+    # UTC
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    
+    # One hold per cart line, and the sweeper reads the expired holds in expires_at order
+    __table_args__ = (
+        Index('uq_stock_holds_cart_id_product_id', 'cart_id', 'product_id', unique=True),
+        Index('ix_stock_holds_expires_at', 'expires_at', 'id'),
+    )
+    
+    
 class Warehouse(Base):
     __tablename__ = "warehouse"
     
@@ -143,6 +196,11 @@ class Orders(Base):
     order_product = relationship("OrderItem", back_populates="order")
     user = relationship("User", back_populates='orders')
     
+    # Backs the order history pages, per user (newest first) and across users
+    __table_args__ = (
+        Index('ix_orders_user_id_order_date', 'user_id', 'order_date', 'id'),
+    )
+    
 
 class OrderItem(Base):
     __tablename__ = 'order_items'
@@ -153,6 +211,8 @@ class OrderItem(Base):
     quantity = Column(DECIMAL, nullable=False)
     price = Column(DECIMAL, nullable=False)
     total_price = Column(DECIMAL, nullable=False)
+    # Owner of the product when it was ordered, what the sales rollups count the line for (still known once the product is deleted)
+    seller_id = Column(Integer, nullable=True)
     
     # relationship with order
     order = relationship("Orders", back_populates="order_product")
@@ -164,6 +224,50 @@ class OrderItem(Base):
         return f"id:{self.id}\norder_id:{self.order_id}"
     
     
+# Side effects of a change (emails, invoices, syncs...) to run after it is committed, written in the change's
+# own transaction and delivered by the outbox worker (e_commerce_api/outbox.py)
+
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+    
+    id = Column(Integer, primary_key=True, index=True, nullable=False)
+    topic = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=datetime.utcnow)
+    # Next delivery attempt (UTC), NULL once delivery was given up
+    available_at = Column(TIMESTAMP(timezone=True), nullable=True, default=datetime.utcnow)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+    
+    # The worker claims the due messages in available_at order
+    __table_args__ = (
+        Index('ix_outbox_available_at', 'available_at', 'id'),
+    )
+    
+
+# Sales rollups, kept up to date by order placement and cancellation (e_commerce_api/sales.py)
+# and rebuilt from the orders with `python manage.py rebuild-sales-rollups`
+
+class SellerDailySales(Base):
+    __tablename__ = 'seller_daily_sales'
+    
+    seller_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    day = Column(Date, primary_key=True, nullable=False)
+    orders = Column(Integer, nullable=False, default=0)
+    units = Column(DECIMAL, nullable=False, default=0)
+    revenue = Column(DECIMAL, nullable=False, default=0)
+    
+
+class SellerProductDailySales(Base):
+    __tablename__ = 'seller_product_daily_sales'
+    
+    seller_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    day = Column(Date, primary_key=True, nullable=False)
+    product_id = Column(Integer, primary_key=True, nullable=False)
+    units = Column(DECIMAL, nullable=False, default=0)
+    revenue = Column(DECIMAL, nullable=False, default=0)
+    
+    
 class Chat(Base):
     __tablename__ = 'chats'
     
@@ -0,0 +1,80 @@
+'''
+ordering.py places orders: it takes the stock and writes the order and its items.
+
+Stock is taken with one conditional UPDATE over all the products of the order
+(available_to_sell >= the quantity ordered, checked by the database on the row
+it updates), so two buyers racing for the last units cannot both get them. The
+price and seller of each line are read back from that same UPDATE. The order is
+also added to the sellers' sales rollups (sales.py) and an order.placed message
+to the outbox (outbox.py). Nothing is committed
+here: the caller commits once the rest of its transaction is written, or rolls
+back, and then the stock taken is given back along with everything else.
+
+'''
+
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import case, insert, update
+from sqlalchemy.orm import Session
+
+from e_commerce_api.models import OrderItem, Orders, Product
+from e_commerce_api.outbox import enqueue
+from e_commerce_api.reservations import release_holds
+from e_commerce_api.sales import record_sales
+
+
+def take_stock(db: Session, quantities: Dict[int, int]) -> Dict[int, Any]:
+    '''
+    Takes quantities (product id -> quantity) out of stock in one statement, all or nothing.
+    Returns the price and owner_id of each product. Rolls the session back and raises when a product
+    does not exist (404) or has not enough stock (400).
+    '''
+
+    ordered = case(quantities, value=Product.id)
+    statement = update(Product) \
+        .where(Product.id.in_(quantities), Product.available_to_sell >= ordered) \
+        .values(quantity_available=Product.quantity_available - ordered, last_edited=datetime.now()) \
+        .returning(Product.id, Product.price, Product.owner_id) \
+        .execution_options(synchronize_session=False)
+    products = {i.id: i for i in db.execute(statement).all()}
+
+    if len(products) < len(quantities):
+        existing_ids = {i for (i,) in db.query(Product.id).filter(Product.id.in_(quantities)).all()}
+        db.rollback()
+        missing_ids = sorted(set(quantities) - existing_ids)
+        if len(missing_ids) > 0:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Invalid Product ID', 'product_ids': missing_ids})
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail={'message': 'Not enough products available', 'product_ids': sorted(set(quantities) - set(products))})
+
+    return products
+
+
+def place_order(db: Session, user_id: int, quantities: Dict[int, int], cart_id: Optional[int] = None) -> Orders:
+    '''
+    Takes the stock and adds the order with its items to the session. Raises like take_stock.
+    The holds of cart_id on the ordered products are released first, the units they held can be ordered.
+    '''
+
+    if cart_id != None:
+        release_holds(db, cart_id, quantities)
+    products = take_stock(db, quantities)
+
+    order = Orders(user_id=user_id, order_date=datetime.now(),
+                   order_quantity=sum(quantities.values()),
+                   total_price=sum(products[i].price * quantity for i, quantity in quantities.items()))
+    db.add(order)
+    db.flush()
+
+    db.execute(insert(OrderItem), [
+        {'order_id': order.id, 'product_id': i, 'seller_id': products[i].owner_id, 'quantity': quantity, 'price': products[i].price, 'total_price': products[i].price * quantity}
+        for i, quantity in quantities.items()
+    ])
+    record_sales(db, order.order_date.date(), [(i, products[i].owner_id, quantity, products[i].price * quantity) for i, quantity in quantities.items()])
+    enqueue(db, 'order.placed', {
+        'order_id': order.id, 'user_id': user_id, 'total_price': float(order.total_price), # type: ignore
+        'items': [{'product_id': i, 'seller_id': products[i].owner_id, 'quantity': quantity, 'price': float(products[i].price)} for i, quantity in quantities.items()],
+    })
+    return order
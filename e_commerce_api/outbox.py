@@ -0,0 +1,229 @@
+'''
+outbox.py runs the side effects of a change (emails, invoices, syncs with other
+systems...) after the change is committed, outside of the request.
+
+A request only adds a message to the outbox table with enqueue(), in its own
+transaction: the message exists if and only if the change was committed, and
+the request does not wait for the side effect. OutboxWorker, started with the
+app, claims the due messages in batches and hands each one to the handler of
+its topic, at most OUTBOX_CONCURRENCY at a time. A delivered message is
+deleted. A failed one is retried later with exponential backoff, and after
+OUTBOX_MAX_ATTEMPTS failures it is kept with its last error and no longer
+retried.
+
+Handlers are registered per topic with @handler('topic'). They get the payload
+(a JSON dict), may be plain or async functions, and must tolerate running more
+than once for the same message (delivery is at least once).
+
+'''
+
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+
+from e_commerce_api.database import SessionLocal
+from e_commerce_api.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 8))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_HANDLER_TIMEOUT = float(os.environ.get('OUTBOX_HANDLER_TIMEOUT', 30))
+# Set to 0 to run the worker in another process than the API (or not at all)
+OUTBOX_WORKER = os.environ.get('OUTBOX_WORKER', '1') != '0'
+
+# Retry delays: 2 s, 4 s, 8 s... up to 10 minutes, with jitter so failed messages do not all come back together
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 600
+
+handlers: Dict[str, Callable[[dict], Any]] = {}
+
+
+def handler(topic: str):
+    '''Registers the decorated function as the handler of topic.'''
+
+    def register(function):
+        handlers[topic] = function
+        return function
+    return register
+
+
+def enqueue(db: Session, topic: str, payload: dict) -> None:
+    '''Adds a message to the session, it is delivered once the caller commits.'''
+
+    db.add(OutboxMessage(topic=topic, payload=payload))
+
+
+def backoff_seconds(attempts: int) -> float:
+    return min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+
+
+def outbox_depth(db: Session) -> Dict[str, Any]:
+    '''Messages waiting for delivery, messages given up on and the age of the oldest waiting one.'''
+
+    pending, oldest = db.query(func.count(OutboxMessage.id), func.min(OutboxMessage.created_at)).filter(OutboxMessage.available_at != None).one()
+    dead = db.query(func.count(OutboxMessage.id)).filter(OutboxMessage.available_at == None).scalar()
+    return {
+        'pending': pending,
+        'dead': dead,
+        'oldest_pending_age_seconds': (datetime.utcnow() - oldest).total_seconds() if oldest != None else 0.0,
+    }
+
+
+class OutboxWorker:
+    def __init__(self, session_factory, batch_size: int = OUTBOX_BATCH_SIZE, concurrency: int = OUTBOX_CONCURRENCY,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, handler_timeout: float = OUTBOX_HANDLER_TIMEOUT, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.handler_timeout = handler_timeout
+        self.max_attempts = max_attempts
+        # A claimed message becomes due again after the lease, in case its worker dies before reporting back.
+        # It covers a whole batch: batch_size / concurrency rounds of handlers running up to the timeout
+        self.lease = timedelta(seconds=handler_timeout * -(-batch_size // concurrency) + 30)
+
+        self.delivered = 0
+        self.failed = 0
+        self.given_up = 0
+        self.last_delivery_lag_seconds: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    # RUNNING THE WORKER ----------------------------------------------------------------
+
+    async def start(self) -> None:
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task == None:
+            return
+        self._stopping.set() # type: ignore
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set(): # type: ignore
+            try:
+                claimed = await self.run_once()
+            except Exception:
+                logger.exception('outbox batch failed')
+                claimed = 0
+            # A full batch means more messages are probably due, the next one is claimed right away
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval) # type: ignore
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run_once(self) -> int:
+        '''Claims and delivers one batch. Returns the number of messages claimed.'''
+
+        messages = await asyncio.to_thread(self._claim)
+        if len(messages) == 0:
+            return 0
+
+        limit = asyncio.Semaphore(self.concurrency)
+        errors = await asyncio.gather(*[self._deliver(limit, i) for i in messages])
+        await asyncio.to_thread(self._report, messages, errors)
+        return len(messages)
+
+    # -----------------------------------------------------------------------------------
+
+    # ONE BATCH -------------------------------------------------------------------------
+
+    def _claim(self) -> List[Any]:
+        now = datetime.utcnow()
+        due = select(OutboxMessage.id).where(OutboxMessage.available_at <= now).order_by(OutboxMessage.available_at, OutboxMessage.id).limit(self.batch_size)
+
+        # Moving available_at past the lease is the claim, a message claimed by another worker is no longer due
+        with self.session_factory() as db:
+            messages = db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(due), OutboxMessage.available_at <= now)
+                .values(available_at=now + self.lease)
+                .returning(OutboxMessage.id, OutboxMessage.topic, OutboxMessage.payload, OutboxMessage.attempts, OutboxMessage.created_at)
+                .execution_options(synchronize_session=False)
+            ).all()
+            db.commit()
+        return sorted(messages, key=lambda i: i.id)
+
+    async def _deliver(self, limit: asyncio.Semaphore, message) -> Optional[str]:
+        # Returns None once delivered, the error otherwise
+        function = handlers.get(message.topic)
+        if function == None:
+            logger.warning('outbox message %s dropped, no handler for topic %s', message.id, message.topic)
+            return None
+
+        async with limit:
+            try:
+                if asyncio.iscoroutinefunction(function):
+                    await asyncio.wait_for(function(message.payload), self.handler_timeout)
+                else:
+                    await asyncio.wait_for(asyncio.to_thread(function, message.payload), self.handler_timeout)
+                return None
+            except Exception as e:
+                logger.warning('outbox message %s (%s) failed: %r', message.id, message.topic, e)
+                return repr(e)
+
+    def _report(self, messages: List[Any], errors: List[Optional[str]]) -> None:
+        now = datetime.utcnow()
+        delivered = [message for message, error in zip(messages, errors) if error == None]
+        failed = [(message, error) for message, error in zip(messages, errors) if error != None]
+
+        with self.session_factory() as db:
+            if len(delivered) > 0:
+                db.execute(delete(OutboxMessage).where(OutboxMessage.id.in_([i.id for i in delivered])).execution_options(synchronize_session=False))
+            for message, error in failed:
+                attempts = message.attempts + 1
+                retry_at = now + timedelta(seconds=backoff_seconds(attempts)) if attempts < self.max_attempts else None
+                db.execute(update(OutboxMessage).where(OutboxMessage.id == message.id)
+                           .values(attempts=attempts, available_at=retry_at, last_error=error)
+                           .execution_options(synchronize_session=False))
+                if retry_at == None:
+                    self.given_up += 1
+            db.commit()
+
+        self.delivered += len(delivered)
+        self.failed += len(failed)
+        if len(delivered) > 0:
+            self.last_delivery_lag_seconds = max((now - i.created_at).total_seconds() for i in delivered)
+
+    # -----------------------------------------------------------------------------------
+
+    def metrics(self, db: Session) -> Dict[str, Any]:
+        return {
+            **outbox_depth(db),
+            'running': self._task != None,
+            'delivered': self.delivered,
+            'failed_attempts': self.failed,
+            'given_up': self.given_up,
+            'last_delivery_lag_seconds': self.last_delivery_lag_seconds,
+        }
+
+
+outbox_worker = OutboxWorker(SessionLocal)
+
+
+# ORDER TOPICS ----------------------------------------------------------------------
+# Where emails, invoices and syncs with other systems plug in, for now the events are only logged
+
+@handler('order.placed')
+def log_order_placed(payload: dict) -> None:
+    logger.info('order %s placed by user %s, total %s', payload['order_id'], payload['user_id'], payload['total_price'])
+
+
+@handler('order.cancelled')
+def log_order_cancelled(payload: dict) -> None:
+    logger.info('order %s cancelled by user %s', payload['order_id'], payload['user_id'])
+
+# -----------------------------------------------------------------------------------
@@ -0,0 +1,116 @@
+'''
+pagination.py implements opaque cursor (keyset) pagination for list endpoints.
+
+A page is read with ORDER BY <sort keys> and the next page continues after the
+last row returned with a WHERE on those same keys, so a request only reads the
+rows it returns instead of skipping over OFFSET rows. The sort keys must end
+with a unique column (the primary key) so that the order is total.
+
+'''
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, false, or_
+from sqlalchemy.orm import Query
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# (column or expression, descending)
+SortKey = Tuple[Any, bool]
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {'t': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'d': str(value)}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict) and 't' in value:
+        return datetime.fromisoformat(value['t'])
+    if isinstance(value, dict) and 'd' in value:
+        return Decimal(value['d'])
+    return value
+
+
+def encode_cursor(values: List[Any], scope: str = '') -> str:
+    payload = json.dumps({'s': scope, 'k': [_dump_value(i) for i in values]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, scope: str = '', size: Optional[int] = None) -> List[Any]:
+    invalid_cursor = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Invalid cursor'})
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = [_load_value(i) for i in payload['k']]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise invalid_cursor
+
+    # A cursor is only valid for the ordering that produced it
+    if payload.get('s') != scope or (size != None and len(values) != size):
+        raise invalid_cursor
+    return values
+
+
+# Databases that sort NULL below every value (first in ascending order), the others sort it above. Pages follow the
+# database's own order rather than asking for NULLS FIRST / LAST, which the indexes behind the sort keys could not serve
+NULLS_SORT_LOW = {'sqlite', 'mysql', 'mssql'}
+
+
+def _key_after(expression, descending: bool, value, nulls_low: bool):
+    # The rows after value on one sort key, and the rows equal to it. A NULL compares to nothing with < > =, so the
+    # rows holding NULL are matched with IS (NOT) NULL, on the side of the order where the database puts them
+    if not getattr(expression, 'nullable', True):
+        return (expression < value if descending else expression > value), expression == value
+
+    nulls_first = nulls_low != descending
+    if value == None:
+        return (expression.is_not(None) if nulls_first else false()), expression.is_(None)
+
+    step = expression < value if descending else expression > value
+    return (step if nulls_first else or_(step, expression.is_(None))), expression == value
+
+
+def _after(keys: List[SortKey], values: List[Any], nulls_low: bool = True):
+    # (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y), which every database can use an index for
+    clauses = []
+    equal = []
+    for (expression, descending), value in zip(keys, values):
+        step, same = _key_after(expression, descending, value, nulls_low)
+        clauses.append(and_(*equal, step))
+        equal.append(same)
+    return or_(*clauses)
+
+
+def keyset_page(query: Query, keys: List[SortKey], cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, scope: str = ''):
+    '''
+    Orders query by keys and reads one page of it.
+    Returns the rows of the page and the cursor of the next page (None on the last page).
+    '''
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    width = len(query.column_descriptions)
+
+    if cursor != None:
+        nulls_low = query.session.get_bind().dialect.name in NULLS_SORT_LOW
+        query = query.filter(_after(keys, decode_cursor(cursor, scope, len(keys)), nulls_low))
+
+    query = query.order_by(*[expression.desc() if descending else expression.asc() for expression, descending in keys])
+    rows = query.add_columns(*[expression.label(f'_page_key_{i}') for i, (expression, _) in enumerate(keys)]).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][width:]), scope)
+
+    # A query of one entity gives back the entities, a query of columns the rows (with the sort keys added at the end)
+    return ([row[0] for row in rows] if width == 1 else rows), next_cursor
@@ -0,0 +1,93 @@
+'''
+passwords.py hashes and checks passwords on a dedicated, bounded thread pool.
+
+bcrypt is slow on purpose. Run inline, a burst of logins would occupy every
+thread of the request threadpool and starve unrelated requests. Hashes run on
+PASSWORD_HASH_WORKERS threads of their own instead (bcrypt releases the GIL, so
+they do run in parallel) and at most PASSWORD_HASH_QUEUE_LIMIT more may wait
+for one. Past that a request is turned away with a 503 and Retry-After rather
+than queued behind work it would time out on anyway. Async endpoints await
+the same pool with the *_async functions, without holding any thread while
+they wait: every endpoint that hashes (login, registration, password change)
+is async, so a burst of them cannot take the threadpool from the others.
+
+The work factor comes from BCRYPT_ROUNDS. Hashes made with another cost are
+flagged by verify_and_update so login can replace them transparently.
+
+'''
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', PASSWORD_HASH_WORKERS * 4))
+
+@functools.lru_cache(maxsize=None)
+def password_context():
+    # Built (and passlib imported) on the first hash rather than when a worker starts
+    from passlib.context import CryptContext
+    # min_rounds = max_rounds = rounds makes any hash with a different cost (higher or lower) need an update
+    return CryptContext(schemes=['bcrypt'], deprecated='auto',
+                        bcrypt__rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_LIMIT)
+
+
+def _submit(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={'message': 'Too many password checks in progress, retry shortly'},
+            headers={'Retry-After': '1'},
+        )
+    try:
+        future = _pool.submit(function, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def _run(function, *args):
+    return _submit(function, *args).result()
+
+
+async def _run_async(function, *args):
+    return await asyncio.wrap_future(_submit(function, *args))
+
+
+def hash_password(original_password) -> str:
+    return _run(password_context().hash, original_password)
+
+
+def verify_password(original_password, hashed_password) -> bool:
+    return _run(password_context().verify, original_password, hashed_password)
+
+
+def verify_and_update(original_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    '''Checks a password. Also returns a new hash when the stored one was made with another work factor, None otherwise.'''
+    return _run(password_context().verify_and_update, original_password, hashed_password)
+
+
+# For async endpoints, the event loop keeps running while the hash is computed or checked
+
+async def hash_password_async(original_password) -> str:
+    return await _run_async(password_context().hash, original_password)
+
+
+async def verify_password_async(original_password, hashed_password) -> bool:
+    return await _run_async(password_context().verify, original_password, hashed_password)
+
+
+async def verify_and_update_async(original_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    '''verify_and_update for async endpoints.'''
+    return await _run_async(password_context().verify_and_update, original_password, hashed_password)
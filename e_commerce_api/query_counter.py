@@ -0,0 +1,172 @@
+'''
+query_counter.py counts and times the SQL statements run for each request.
+
+Every engine made by database.make_engine / make_async_engine is registered here. Its statements
+are counted (before and after each cursor execute) with DEBUG_QUERIES=1, or from the first
+count_queries() block on: the listeners cost about 9 us per statement, production does not pay
+them. The statements of a request are collected in a QueryStats held in a context variable,
+which follows the request into the threadpool and into run_sync.
+
+A statement shape is its SQL with the parameters left out (and IN lists collapsed): the same
+shape run again and again in one request is usually a query per row (N+1) and is reported
+as repeated.
+
+With DEBUG_QUERIES=1 the app answers every request with the headers
+
+  X-Query-Count      statements run
+  X-Query-Time-Ms    time spent in them
+  X-Query-Repeated   shapes run at least REPEATED_QUERY_THRESHOLD times, if any
+
+and logs the repeated shapes as warnings. In tests, assert_max_queries checks an endpoint
+against its query budget:
+
+    with assert_max_queries(2):
+        client.get('/cart/1', headers=headers)
+
+'''
+
+import logging
+import os
+import re
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+
+# Adds the query headers to every response (and the warnings to the log), for development only
+DEBUG_QUERIES = os.environ.get('DEBUG_QUERIES', '0') == '1'
+# Times the same statement shape can run in one request before it is reported as repeated
+REPEATED_QUERY_THRESHOLD = int(os.environ.get('REPEATED_QUERY_THRESHOLD', 3))
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+# IN (?, ?, ?) / IN (%(id_1_1)s, %(id_1_2)s): the number of values does not change the shape
+_IN_LIST = re.compile(r'\(\s*(\?|%\(\w+\)s|\$\d+)(\s*,\s*(\?|%\(\w+\)s|\$\d+))+\s*\)')
+
+
+def statement_shape(statement: str) -> str:
+    '''The statement without its parameters and with IN lists collapsed, the same for every row of an N+1.'''
+    return _IN_LIST.sub('(?)', _WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryStats:
+    '''The statements run during a request (or a with count_queries() block) and the time spent in them.'''
+
+    def __init__(self):
+        self.statements: List[Tuple[str, float]] = []
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.statements.append((statement_shape(statement), seconds))
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(i[1] for i in self.statements)
+
+    def repeated(self, threshold: int = REPEATED_QUERY_THRESHOLD) -> List[Tuple[str, int]]:
+        '''Shapes run at least threshold times, most repeated first.'''
+        return [(shape, n) for shape, n in Counter(i[0] for i in self.statements).most_common() if n >= threshold]
+
+    def report(self) -> str:
+        lines = [f'{self.count} queries in {self.seconds * 1e3:.1f} ms']
+        lines += [f'  {n}x {shape}' for shape, n in self.repeated(2)]
+        return '\n'.join(lines)
+
+
+# The stats of the request being served, set by QueryCountMiddleware
+_request_stats: ContextVar[Optional[QueryStats]] = ContextVar('request_query_stats', default=None)
+# The open count_queries() blocks, they see every statement whatever the thread or task running it (e.g. TestClient's portal)
+_captures: List[QueryStats] = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # On the statement's execution context, a statement that fails leaves nothing behind
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_started
+    stats = _request_stats.get()
+    if stats != None:
+        stats.record(statement, seconds)
+    for i in _captures:
+        i.record(statement, seconds)
+
+
+# The engines whose statements can be counted
+_engines = weakref.WeakSet()
+
+
+def _listen(engine) -> None:
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def instrument(engine) -> None:
+    '''Makes the statements run on engine countable (a sync engine, for an async one pass its sync_engine).'''
+    _engines.add(engine)
+    if DEBUG_QUERIES or len(_captures) > 0:
+        _listen(engine)
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryStats]:
+    '''Collects the statements run on every instrumented engine inside the block.'''
+    for i in list(_engines):
+        _listen(i)
+    stats = QueryStats()
+    _captures.append(stats)
+    try:
+        yield stats
+    finally:
+        _captures.remove(stats)
+
+
+@contextmanager
+def assert_max_queries(max_queries: int) -> Iterator[QueryStats]:
+    '''Fails (AssertionError, listing the statements) when the block runs more than max_queries statements.'''
+    with count_queries() as stats:
+        yield stats
+    assert stats.count <= max_queries, f'expected at most {max_queries} queries, got {stats.report()}'
+
+
+class QueryCountMiddleware:
+    '''ASGI middleware: counts the statements of each HTTP request and reports them in the response headers.'''
+
+    def __init__(self, app, threshold: int = REPEATED_QUERY_THRESHOLD):
+        self.app = app
+        self.threshold = threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = _request_stats.set(stats)
+
+        async def send_with_counts(message):
+            if message['type'] == 'http.response.start':
+                repeated = stats.repeated(self.threshold)
+                headers = list(message.get('headers', []))
+                headers.append((b'x-query-count', str(stats.count).encode()))
+                headers.append((b'x-query-time-ms', f'{stats.seconds * 1e3:.2f}'.encode()))
+                if len(repeated) > 0:
+                    headers.append((b'x-query-repeated', ', '.join(f'{n}x {shape[:80]}' for shape, n in repeated).encode('latin-1', 'replace')))
+                    for shape, n in repeated:
+                        logger.warning('%s %s ran the same query %d times (N+1?): %s', scope['method'], scope['path'], n, shape)
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_counts)
+        finally:
+            _request_stats.reset(token)
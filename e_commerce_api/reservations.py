@@ -0,0 +1,179 @@
+'''
+reservations.py holds stock for the products in carts.
+
+Adding a product to a cart puts a hold on that many units for
+CART_HOLD_TTL_SECONDS (every addition to the line renews it), so shoppers can
+no longer all fill their carts with the last unit. Held units are counted in
+Product.quantity_reserved, kept up to date in the same statements that create
+and release holds: what is left to sell is quantity_available -
+quantity_reserved (Product.available_to_sell), read from the product row
+itself instead of summing the holds.
+
+A hold is released when its line is ordered or removed from the cart, or when
+it expires: HoldSweeper, started with the app, deletes the expired holds in
+batches (in expires_at order, from ix_stock_holds_expires_at) and gives their
+units back. `python manage.py release-expired-holds` does the same once.
+
+'''
+
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.orm import Session
+
+from e_commerce_api.database import SessionLocal, upsert_insert
+from e_commerce_api.models import Product, StockHold
+
+logger = logging.getLogger(__name__)
+
+CART_HOLD_TTL_SECONDS = int(os.environ.get('CART_HOLD_TTL_SECONDS', 900))
+HOLD_SWEEP_INTERVAL = float(os.environ.get('HOLD_SWEEP_INTERVAL', 30))
+HOLD_SWEEP_BATCH_SIZE = int(os.environ.get('HOLD_SWEEP_BATCH_SIZE', 500))
+
+
+# TAKING AND GIVING BACK HOLDS ------------------------------------------------------
+
+def hold_stock(db: Session, cart_id: int, product_id: int, quantity: int) -> bool:
+    '''
+    Holds quantity more units of a product for a cart, if that many are available to sell.
+    Returns False (and holds nothing) otherwise. The caller commits.
+    '''
+
+    reserved = db.execute(
+        update(Product)
+        .where(Product.id == product_id, Product.available_to_sell >= quantity)
+        .values(quantity_reserved=Product.quantity_reserved + quantity)
+        .returning(Product.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if reserved == None:
+        return False
+
+    expires_at = datetime.utcnow() + timedelta(seconds=CART_HOLD_TTL_SECONDS)
+    upsert = upsert_insert(db.get_bind())(StockHold) \
+        .values(cart_id=cart_id, product_id=product_id, quantity=quantity, expires_at=expires_at)
+    db.execute(upsert.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={'quantity': StockHold.quantity + upsert.excluded.quantity, 'expires_at': upsert.excluded.expires_at},
+    ))
+    return True
+
+
+def _unreserve(db: Session, quantities: Dict[int, float]) -> None:
+    if len(quantities) == 0:
+        return
+    db.execute(
+        update(Product)
+        .where(Product.id.in_(quantities))
+        .values(quantity_reserved=Product.quantity_reserved - case(quantities, value=Product.id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _release(db: Session, statement) -> int:
+    # Deletes the holds selected by statement and gives their units back, returns the number of holds released
+    quantities: Dict[int, float] = defaultdict(int)
+    released = db.execute(statement.returning(StockHold.product_id, StockHold.quantity).execution_options(synchronize_session=False)).all()
+    for product_id, quantity in released:
+        quantities[product_id] += quantity
+    _unreserve(db, quantities)
+    return len(released)
+
+
+def release_holds(db: Session, cart_id: int, product_ids: Optional[Iterable[int]] = None) -> int:
+    '''Releases the holds of a cart, only those on product_ids if given. The caller commits.'''
+
+    statement = delete(StockHold).where(StockHold.cart_id == cart_id)
+    if product_ids != None:
+        statement = statement.where(StockHold.product_id.in_(list(product_ids)))
+    return _release(db, statement)
+
+
+def release_stock(db: Session, cart_id: int, product_id: int, quantity: int) -> None:
+    '''Gives back quantity units held for a cart line, or its whole hold when that is less (part of it expired). The caller commits.'''
+
+    kept = db.execute(
+        update(StockHold)
+        .where(StockHold.cart_id == cart_id, StockHold.product_id == product_id, StockHold.quantity > quantity)
+        .values(quantity=StockHold.quantity - quantity)
+        .returning(StockHold.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if kept != None:
+        _unreserve(db, {product_id: quantity})
+    else:
+        _release(db, delete(StockHold).where(StockHold.cart_id == cart_id, StockHold.product_id == product_id))
+
+
+def release_expired_holds(db: Session, batch_size: int = HOLD_SWEEP_BATCH_SIZE) -> int:
+    '''Releases up to batch_size expired holds, oldest first. The caller commits. Returns the number released.'''
+
+    expired = select(StockHold.id).where(StockHold.expires_at <= datetime.utcnow()).order_by(StockHold.expires_at, StockHold.id).limit(batch_size)
+    # Deleted rows are only returned to the sweeper that deleted them, two sweepers never give back the same units
+    return _release(db, delete(StockHold).where(StockHold.id.in_(expired)))
+
+
+def sweep_expired_holds(session_factory, batch_size: int = HOLD_SWEEP_BATCH_SIZE) -> int:
+    '''Releases every expired hold, one transaction per batch. Returns the number released.'''
+
+    total = 0
+    while True:
+        with session_factory() as db:
+            released = release_expired_holds(db, batch_size)
+            db.commit()
+        total += released
+        if released < batch_size:
+            return total
+
+
+def recount_reserved(db: Session) -> None:
+    '''Recomputes every product's quantity_reserved from the holds.'''
+
+    held = select(func.coalesce(func.sum(StockHold.quantity), 0)).where(StockHold.product_id == Product.id).scalar_subquery()
+    db.execute(update(Product).values(quantity_reserved=held).execution_options(synchronize_session=False))
+
+# -----------------------------------------------------------------------------------
+
+
+class HoldSweeper:
+    '''Releases expired holds every HOLD_SWEEP_INTERVAL seconds while the app runs.'''
+
+    def __init__(self, session_factory, interval: float = HOLD_SWEEP_INTERVAL, batch_size: int = HOLD_SWEEP_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.released = 0
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def start(self) -> None:
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task == None:
+            return
+        self._stopping.set() # type: ignore
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        # The first sweep waits an interval too, a worker that just started serves its first requests before it
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval) # type: ignore
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                self.released += await asyncio.to_thread(sweep_expired_holds, self.session_factory, self.batch_size)
+            except Exception:
+                logger.exception('releasing expired stock holds failed')
+
+
+hold_sweeper = HoldSweeper(SessionLocal)
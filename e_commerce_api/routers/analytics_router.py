@@ -0,0 +1,77 @@
+'''Sales of the current seller per day: GET /analytics/sales/daily
+Best selling products of the current seller: GET /analytics/sales/products
+
+Both read the sales rollups (e_commerce_api/sales.py), never the orders.'''
+
+from datetime import date
+from typing import Annotated, List
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func
+
+from e_commerce_api import models
+from e_commerce_api.database import SessionLocal, get_read_db
+from e_commerce_api.routers.user_router import get_current_active_user
+from e_commerce_api.schemas.analytics_schema import DailySales, ProductSales
+from e_commerce_api.schemas.user_schema import Principal
+from e_commerce_api.serialization import SerializedJSONResponse, dump_list
+
+router_analytics = APIRouter(
+    tags = ['Analytics Endpoints']
+)
+
+
+class SalesPeriod:
+    # Days from date_from to date_to, both included
+    def __init__(self, date_from: date | None = None, date_to: date | None = None):
+        self.date_from = date_from
+        self.date_to = date_to
+    
+    def apply(self, query, day_column):
+        if self.date_from != None:
+            query = query.filter(day_column >= self.date_from)
+        if self.date_to != None:
+            query = query.filter(day_column <= self.date_to)
+        return query
+
+
+def _seller(current_user: Principal) -> Principal:
+    if not current_user.is_seller:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    return current_user
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to get the orders, units and revenue of the current seller per day
+
+@router_analytics.get('/analytics/sales/daily', response_model=List[DailySales], response_class=SerializedJSONResponse)
+def get_daily_sales(current_user: Annotated[Principal, Depends(get_current_active_user)], period: SalesPeriod = Depends(), db : SessionLocal = Depends(get_read_db)): # type: ignore
+    seller = _seller(current_user)
+    rollup = models.SellerDailySales
+    
+    query = db.query(rollup.day, rollup.orders, rollup.units, rollup.revenue).filter(rollup.seller_id == seller.id)
+    query = period.apply(query, rollup.day).order_by(rollup.day)
+    
+    return SerializedJSONResponse(dump_list(DailySales, query.all()))
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to get the best selling products of the current seller over a period
+
+@router_analytics.get('/analytics/sales/products', response_model=List[ProductSales], response_class=SerializedJSONResponse)
+def get_product_sales(current_user: Annotated[Principal, Depends(get_current_active_user)], period: SalesPeriod = Depends(), limit: int = Query(20, ge=1, le=100), db : SessionLocal = Depends(get_read_db)): # type: ignore
+    seller = _seller(current_user)
+    rollup = models.SellerProductDailySales
+    
+    totals = db.query(rollup.product_id, func.sum(rollup.units).label('units'), func.sum(rollup.revenue).label('revenue')).filter(rollup.seller_id == seller.id)
+    totals = period.apply(totals, rollup.day).group_by(rollup.product_id).subquery()
+    
+    # Sold products may have been deleted since, they are still listed without a title
+    query = db.query(totals.c.product_id, models.Product.title, totals.c.units, totals.c.revenue) \
+        .outerjoin(models.Product, models.Product.id == totals.c.product_id) \
+        .order_by(totals.c.revenue.desc(), totals.c.product_id) \
+        .limit(limit)
+    
+    return SerializedJSONResponse(dump_list(ProductSales, query.all()))
+
+# ------------------------------------------------------------------------------------------------------------------------------------
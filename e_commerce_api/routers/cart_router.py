@@ -1,52 +1,81 @@
 '''Add a product to the cart: POST /cart
 Get user's cart: GET /cart
-Update cart: PUT /cart
-Remove a product from the cart: DELETE /cart/{product_id}'''
+Change the quantity of a product in the cart by a signed amount: PUT /cart
+Remove a product from the cart: DELETE /cart/{product_id}
+Turn the cart into an order: POST /cart/{cart_id}/checkout'''
 
 from datetime import datetime
 from typing import Annotated, List
-from fastapi import Depends, APIRouter, HTTPException, status
+from fastapi import Depends, APIRouter, HTTPException, Response, status
 import pydantic
-import sqlalchemy
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from e_commerce_api.database import SessionLocal, get_db
-from sqlalchemy.orm import Session
+from e_commerce_api.database import get_async_db, mark_written, upsert_insert
 from e_commerce_api.models import Product as product_model, Cart as cart_model, CartItem as cart_item_model, User as user_model
 from e_commerce_api.routers.user_router import get_current_active_user
+from e_commerce_api.schemas.user_schema import Principal
 from e_commerce_api.schemas.cart_schema import AddProductRequest, CartProductResponse, CartResponse
+from e_commerce_api.schemas.order_schema import Order
+from e_commerce_api.cache import invalidate_product
+from e_commerce_api.ordering import place_order
+from e_commerce_api.reservations import hold_stock, release_holds, release_stock
 
 
 router_cart = APIRouter(
     tags=['Cart Endpoints']
 )
 
-# ------------------------------------------------------------------------------------------------------------------------------------
+# The cart endpoints are async. Stock is held and orders are placed by the same code as everywhere else (reservations.py, ordering.py),
+# run on the request's async connection with run_sync
 
-# API Endpoint to add a product to cart
 
-@router_cart.post('/cart')
-def add_product_to_cart(current_user: Annotated[user_model, Depends(get_current_active_user)], details: AddProductRequest, db: SessionLocal = Depends(get_db)):  # type: ignore
+async def _add_to_cart(db: AsyncSession, current_user: Principal, details: AddProductRequest) -> int:
+    '''
+    Adds details.quantity (1 by default) of a product to the cart, as a new line or to its existing line.
+    The units are held for the cart first (reservations.py), the line is only written if they could be. Returns its new quantity.
+    '''
+    
+    if details.cart_id != current_user.cart_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    quantity = details.quantity if details.quantity != None else 1
+    if quantity < 1:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Quantity mentioned is less than one'})
+    
+    upsert = upsert_insert(db.get_bind())(cart_item_model) \
+        .values(cart_id=details.cart_id, product_id=details.product_id, quantity=quantity)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={'quantity': cart_item_model.quantity + upsert.excluded.quantity},
+    )
     
     try:
-        db_cart = db.query(cart_model).filter(cart_model.id == details.cart_id).first()
-        
-        if db_cart.user_id != current_user.id:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+        held = await db.run_sync(hold_stock, details.cart_id, details.product_id, quantity)
+        new_quantity = (await db.execute(upsert.returning(cart_item_model.quantity))).scalar() if held else None
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': f'{e}'})
     
-        if (details.quantity < 0): # type: ignore
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Quantity mentioned is less than zero'})
-      
-        
-        db.query(product_model).filter(product_model.id == details.product_id).first()
-        cart_item = cart_item_model(cart_id = db_cart.id, product_id= details.product_id, quantity= details.quantity if details.quantity != None else 1,)
-        db.add(cart_item)
-        db.commit()
-        db.refresh(db_cart)     
+    if new_quantity == None:
+        # Nothing held, only now find out why
+        if (await db.execute(select(product_model.id).where(product_model.id == details.product_id))).first() == None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Product with id {details.product_id} does not exist'})
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Quantity mentioned is greater than quantity available'})
     
-        raise HTTPException(status_code=status.HTTP_200_OK, detail={'message': f'Successfully added products with product id: {details.product_id}'})
-        
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'{e}'})
+    return new_quantity
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to add a product to cart
+
+@router_cart.post('/cart')
+async def add_product_to_cart(current_user: Annotated[Principal, Depends(get_current_active_user)], details: AddProductRequest, db: AsyncSession = Depends(get_async_db)):
+    quantity = await _add_to_cart(db, current_user, details)
+    
+    raise HTTPException(status_code=status.HTTP_200_OK, detail={'message': f'Successfully added products with product id: {details.product_id}', 'quantity': quantity})
 
     
    
@@ -58,31 +87,29 @@ def add_product_to_cart(current_user: Annotated[user_model, Depends(get_current_
 # API Endpoint to read a cart
 
 @router_cart.get('/cart/{cart_id}', response_model=CartResponse)
-def read_cart(current_user: Annotated[user_model, Depends(get_current_active_user)], cart_id: int, db: SessionLocal = Depends(get_db)): # type: ignore
+async def read_cart(current_user: Annotated[Principal, Depends(get_current_active_user)], cart_id: int, db: AsyncSession = Depends(get_async_db)):
+    if current_user.cart_id != cart_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    # One query for the whole cart: the lines with their products, line totals and the subtotal (a window sum over the lines)
+    line_total = product_model.price * cart_item_model.quantity
+    lines = (await db.execute(
+        select(product_model.id, product_model.title, product_model.description, product_model.price,
+               cart_item_model.quantity.label('quantity_available'), product_model.category,
+               line_total.label('line_total'), func.sum(line_total).over().label('subtotal'))
+        .join(product_model, product_model.id == cart_item_model.product_id)
+        .where(cart_item_model.cart_id == cart_id)
+        .order_by(cart_item_model.id)
+    )).all()
+    
     try:
-        user_cart = db.query(cart_model).filter(cart_model.id == cart_id).first()
-        
-        if user_cart.user_id != current_user.id:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
-        
-        product = []
-        for i in user_cart.cart_items:
-            product.append(CartProductResponse(id=i.product.id, title=i.product.title,description=i.product.description, price=i.product.price, quantity_available=i.quantity,  category=i.product.category))
-        
-        print(product)
-
-        return CartResponse(id = user_cart.id, 
-                            user_id = user_cart.user_id, 
-                            products=product
+        return CartResponse(id=cart_id, 
+                            user_id=current_user.id, 
+                            products=[CartProductResponse.model_validate(i) for i in lines],
+                            subtotal=lines[0].subtotal if len(lines) > 0 else 0
                             )
-           
-        
-    except pydantic.error_wrappers.ValidationError:
+    except pydantic.ValidationError:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={'message': f'Could not map database field to Response attributes (ORM error)'})
-    except ValueError:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Cart with id {cart_id} does not exist'})
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'{e}'})        
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------
@@ -90,30 +117,51 @@ def read_cart(current_user: Annotated[user_model, Depends(get_current_active_use
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to update a cart 
+# details.quantity (1 by default) is added to the product's line, a negative quantity takes units off it and gives their hold back.
+# The line keeps at least one unit, DELETE /cart/{cart_id} removes it
 
 @router_cart.put('/cart')
-def modify_product_in_cart(current_user: Annotated[user_model, Depends(get_current_active_user)], details: AddProductRequest, db: SessionLocal = Depends(get_db)): # type: ignore
+async def modify_product_in_cart(current_user: Annotated[Principal, Depends(get_current_active_user)], details: AddProductRequest, db: AsyncSession = Depends(get_async_db)):
+    if details.cart_id != current_user.cart_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    change = details.quantity if details.quantity != None else 1
+    if change == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Quantity change cannot be zero'})
+    
+    # Conditional on the line existing and keeping at least one unit, the units are then held or given back in the same transaction
+    statement = update(cart_item_model) \
+        .where(cart_item_model.cart_id == details.cart_id, cart_item_model.product_id == details.product_id, cart_item_model.quantity + change >= 1) \
+        .values(quantity=cart_item_model.quantity + change) \
+        .returning(cart_item_model.quantity) \
+        .execution_options(synchronize_session=False)
+    
+    held = True
     try:
-        db_cart = db.query(cart_model).filter(cart_model.id == details.cart_id).first()
+        quantity = (await db.execute(statement)).scalar()
+        if quantity != None and change > 0:
+            held = await db.run_sync(hold_stock, details.cart_id, details.product_id, change)
+        elif quantity != None:
+            await db.run_sync(release_stock, details.cart_id, details.product_id, -change)
         
-        if db_cart.user_id != current_user.id:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
-        
-        product_exists_instance = db.query(cart_item_model).filter(cart_item_model.cart_id == db_cart.id, cart_item_model.product_id == details.product_id).first()
-        product_instance = db.query(product_model).filter(product_model.id == details.product_id).first()
-        
-        if product_instance.quantity_available < product_exists_instance.quantity + details.quantity:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Quantity mentioned is greater than quantity available'})
-        else:   
-            product_exists_instance.quantity += details.quantity if details.quantity != None else 1
-            db_cart.last_edited = datetime.now()
-            db.commit()
-            db.refresh(db_cart) 
-        
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'{e}'})
-
-    pass
+        if quantity != None and held:
+            await db.commit()
+        else:
+            await db.rollback()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': f'{e}'})
+    
+    if quantity == None:
+        # Nothing changed, only now find out why
+        line = (await db.execute(select(cart_item_model.quantity).where(cart_item_model.cart_id == details.cart_id, cart_item_model.product_id == details.product_id))).first()
+        if line == None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Product with id {details.product_id} is not in cart with id {details.cart_id}'})
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'A cart line keeps at least one unit, delete the product from the cart instead'})
+    if not held:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Quantity mentioned is greater than quantity available'})
+    
+    return {'product_id': details.product_id, 'quantity': quantity}
 
 
 
@@ -124,25 +172,68 @@ def modify_product_in_cart(current_user: Annotated[user_model, Depends(get_curre
 # API Endpoint to delete a product from cart
 
 @router_cart.delete('/cart/{cart_id}')
-def delete_product_from_cart(current_user: Annotated[user_model, Depends(get_current_active_user)],cart_id:int, product_id:int, db: SessionLocal = Depends(get_db)): # type: ignore
+async def delete_product_from_cart(current_user: Annotated[Principal, Depends(get_current_active_user)],cart_id:int, product_id:int, db: AsyncSession = Depends(get_async_db)):
+    if current_user.cart_id != cart_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    # The line goes and the units it held are given back, in one transaction
     try:
-        product_cart_instance = db.query(cart_item_model).filter(cart_item_model.cart_id == cart_id , cart_item_model.product_id == product_id).first()
-        cart_instance = db.query(cart_model).filter(cart_model.id == cart_id).first().last_edited = datetime.now()
-        
-        if cart_instance.user_id != current_user.id: # type: ignore
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
-        
-        print(product_cart_instance)
-        db.delete(product_cart_instance)
-        db.commit()
-        db.refresh()
-        return {'message': f'Successfully deleted product with id {product_id} from cart with id {cart_id}'}
-    except sqlalchemy.orm.exc.UnmappedInstanceError: # type: ignore
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Cart with id {cart_id} does not exist'})
-    except Exception as e:
-         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'{e}'})
-    pass
+        deleted = (await db.execute(delete(cart_item_model).where(cart_item_model.cart_id == cart_id, cart_item_model.product_id == product_id)
+                                     .execution_options(synchronize_session=False))).rowcount
+        await db.run_sync(release_holds, cart_id, [product_id])
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': f'{e}'})
+    
+    if deleted == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': f'Product with id {product_id} is not in cart with id {cart_id}'})
+    
+    return {'message': f'Successfully deleted product with id {product_id} from cart with id {cart_id}'}
+
+
 
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# ------------------------------------------------------------------------------------------------------------------------------------
 
+# API Endpoint to order everything in a cart
 
-# ------------------------------------------------------------------------------------------------------------------------------------
\ No newline at end of file
+@router_cart.post('/cart/{cart_id}/checkout', response_model=Order)
+async def checkout_cart(response: Response, current_user: Annotated[Principal, Depends(get_current_active_user)], cart_id: int, db: AsyncSession = Depends(get_async_db)):
+    if current_user.cart_id != cart_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    # The cart lines with their products, one query. The same product added twice is ordered once
+    lines = (await db.execute(
+        select(cart_item_model.product_id, func.sum(cart_item_model.quantity), product_model.id)
+        .outerjoin(product_model, product_model.id == cart_item_model.product_id)
+        .where(cart_item_model.cart_id == cart_id, cart_item_model.quantity > 0)
+        .group_by(cart_item_model.product_id, product_model.id)
+    )).all()
+    
+    if len(lines) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Cart is empty'})
+    
+    missing_ids = [product_id for product_id, _, existing_id in lines if existing_id == None]
+    if len(missing_ids) > 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Products in the cart no longer exist', 'product_ids': missing_ids})
+    
+    quantities = {product_id: int(quantity) for product_id, quantity, _ in lines}
+    
+    # One transaction: the stock, the order, its items and the emptied cart are all written or none of them is
+    try:
+        order = await db.run_sync(place_order, current_user.id, quantities, cart_id=cart_id)
+        await db.execute(delete(cart_item_model).where(cart_item_model.cart_id == cart_id).execution_options(synchronize_session=False))
+        await db.execute(update(cart_model).where(cart_model.id == cart_id).values(last_edited=datetime.now()).execution_options(synchronize_session=False))
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': f'{e}'})
+    
+    invalidate_product(*quantities)
+    mark_written(response, current_user.id)
+    
+    return Order(id=order.id, user_id=order.user_id, order_date=order.order_date, total_quantity=order.order_quantity, total_price=order.total_price)
+
+# ------------------------------------------------------------------------------------------------------------------------------------
@@ -1,29 +1,48 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from typing import List
 
 import sqlalchemy
 from e_commerce_api import models
-from e_commerce_api.database import SessionLocal, get_db
+from e_commerce_api.cache import catalog_cache, invalidate_category
+from e_commerce_api.conditional import conditional_response, make_etag
+from e_commerce_api.database import SessionLocal, get_db, get_read_db
 from e_commerce_api.schemas import category_schema
 
 router_category = APIRouter(
     tags = ['Category Endpoints']
 )
 
+# Categories are cached as plain dicts, ORM instances cannot outlive the session that loaded them
+def _category_dict(category):
+    return {'id': category.id, 'category': category.category} if category != None else None
+
+def cached_category(db, category_id: int):
+    return catalog_cache.get_or_set(f'category:{category_id}', lambda: _category_dict(db.query(models.Categories).filter(models.Categories.id == category_id).first()), tags=[f'category:{category_id}'])
+
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get all categories
 @router_category.get('/categories')
-def get_categories(db : SessionLocal = Depends(get_db)): # type: ignore
-    categories = db.query(models.Categories).all()
+def get_categories(request: Request, response: Response, db : SessionLocal = Depends(get_read_db)): # type: ignore
+    def load_categories():
+        categories = [_category_dict(i) for i in db.query(models.Categories).all()]
+        return categories, make_etag(categories)
+    
+    # Categories have no timestamp, only an ETag is sent
+    categories, etag = catalog_cache.get_or_set('categories', load_categories, tags=['category:*'])
+    
+    not_modified = conditional_response(request, response, etag)
+    if not_modified != None:
+        return not_modified
+    
     return categories
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get a specific category
 @router_category.get('/categories/{category_id}')
-def get_category(category_id: int, db : SessionLocal = Depends(get_db)): # type: ignore
-    categories = db.query(models.Categories).filter(models.Categories.id == category_id).first()
+def get_category(category_id: int, db : SessionLocal = Depends(get_read_db)): # type: ignore
+    categories = cached_category(db, category_id)
     return categories
 
 # ------------------------------------------------------------------------------------------------------------------------------------
@@ -35,6 +54,7 @@ def post_category(category: category_schema.CategoryRequest, db : SessionLocal =
         categories = models.Categories(category=category.name)
         db.add(categories)
         db.commit()
+        invalidate_category(categories.id)
         raise HTTPException(status_code=status.HTTP_201_CREATED, detail="Category created")
     except sqlalchemy.exc.IntegrityError as error: # type: ignore
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Category already exists")
@@ -50,6 +70,7 @@ def post_category(category_id: int, details : category_schema.CategoryRequest, d
         category = db.query(models.Categories).filter(models.Categories.id == category_id).first()
         category.category = details.name
         db.commit()
+        invalidate_category(category_id)
         raise HTTPException(status_code=status.HTTP_201_CREATED, detail="Category updated")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"error: {e}")
@@ -63,6 +84,7 @@ def post_category(category_id: int, db : SessionLocal = Depends(get_db)): # type
         category = db.query(models.Categories).filter(models.Categories.id == category_id).first()
         db.delete(category) 
         db.commit()
+        invalidate_category(category_id)
         raise HTTPException(status_code=status.HTTP_201_CREATED, detail="Category deleted")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"error: {e}")
@@ -1,15 +1,20 @@
 # This file contains the endpoints for searching and filtering products.
 
 # Filter products by price range: GET /products?min_price={min_price}&max_price={max_price}
+# Filter products by category, seller and stock: GET /products?category_id={category_id}&owner_id={owner_id}&in_stock=true
 # Sort products by various criteria: GET /products?sort={criteria}
+# Page through results: GET /products?cursor={cursor}&limit={limit}
 
 from enum import Enum
 from typing import List
-from fastapi import APIRouter, Depends
-from e_commerce_api import models
-from sqlalchemy import or_
-from e_commerce_api.database import SessionLocal, get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.orm import Session
+from e_commerce_api import models, search
+from e_commerce_api.database import get_read_db
+from e_commerce_api.pagination import DEFAULT_PAGE_SIZE, keyset_page
+from e_commerce_api.routers.category_router import cached_category
 from e_commerce_api.schemas.filter_schema import SearchProductResponse
+from e_commerce_api.serialization import SerializedJSONResponse, columns_of, dump_list
 
 
 router_search_filter = APIRouter(
@@ -22,38 +27,87 @@ class SortCriteria(Enum):
     price_dsc = "price_dsc"
     latest = "latest"
 
+# ORDER BY keys (column, descending) for each criteria, each one ends with the id so keyset pagination has a total order
+SORT_KEYS = {
+    SortCriteria.title: [(models.Product.title, False), (models.Product.id, False)],
+    SortCriteria.price_asc: [(models.Product.price, False), (models.Product.id, False)],
+    SortCriteria.price_dsc: [(models.Product.price, True), (models.Product.id, True)],
+    SortCriteria.latest: [(models.Product.created_at, True), (models.Product.id, True)],
+}
+
 # ------------------------------------------------------------------------------------------------------------------------------------
 
-# API Endpoint for searching products by category id
+# SEARCH FILTERS SHARED BY THE PRODUCT LISTING ENDPOINTS -----------------------------------------------------------------------------
+
+class ProductFilters:
+    def __init__(self, keyword: str | None = None, category_id: int | None = None, min_price: float | None = Query(None, ge=0), max_price: float | None = Query(None, ge=0), owner_id: int | None = None, in_stock: bool = False):
+        self.keyword = keyword
+        self.category_id = category_id
+        self.min_price = min_price
+        self.max_price = max_price
+        self.owner_id = owner_id
+        self.in_stock = in_stock
+
 
-@router_search_filter.get('/products/', response_model=List[SearchProductResponse])
-def get_products_search(keyword:str | None = None, category_id: int | None = None, sort_by : SortCriteria | None = None,db : SessionLocal = Depends(get_db)): # type: ignore
+def filter_products(db: Session, filters: ProductFilters):
+    '''
+    Builds the Product query for a set of search filters, every filter is evaluated in the database.
+    Returns the query and the keyword relevance expression (None when there is no keyword).
+    '''
     
-    db_products = []
+    query = db.query(models.Product)
+    relevance = None
     
-    if keyword == None and category_id == None:
-        db_products = db.query(models.Product).all()
-    elif keyword == None and category_id != None:
-        db_category_name = db.query(models.Categories).filter(models.Categories.id == category_id).first().category # type: ignore
-        db_products = db.query(models.Product).filter(models.Product.category == db_category_name).all() # type: ignore
-    elif keyword != None and category_id == None:
-        db_products = db.query(models.Product).filter(or_(models.Product.title.contains(keyword), models.Product.description.contains(keyword))).all() # type: ignore
-    else:
-        db_category_name = db.query(models.Categories).filter(models.Categories.id == category_id,).first().category
-        db_products = db.query(models.Product).filter(or_(models.Product.title.contains(keyword), models.Product.description.contains(keyword)), models.Product.category == db_category_name).all() # type: ignore
+    if filters.category_id != None:
+        db_category = cached_category(db, filters.category_id)
+        if db_category == None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Category does not exist'})
+        query = query.filter(models.Product.category == db_category['category'])
+    
+    if filters.min_price != None:
+        query = query.filter(models.Product.price >= filters.min_price)
+    
+    if filters.max_price != None:
+        query = query.filter(models.Product.price <= filters.max_price)
+    
+    if filters.owner_id != None:
+        query = query.filter(models.Product.owner_id == filters.owner_id)
+    
+    if filters.in_stock:
+        query = query.filter(models.Product.available_to_sell > 0)
+    
+    if filters.keyword != None:
+        query, relevance = search.match_products(db, query, filters.keyword)
     
-    if sort_by == SortCriteria.title:
-        db_products = sorted(db_products, key=lambda x: x.title)
-    elif sort_by == SortCriteria.price_asc:
-        db_products = sorted(db_products, key=lambda x: x.price,)
-    elif sort_by == SortCriteria.price_dsc:
-        db_products = sorted(db_products, key=lambda x: x.price, reverse=True)
-    elif sort_by == SortCriteria.latest:
-        db_products = sorted(db_products, key=lambda x: x.id)
-        
+    return query, relevance
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+def search_page(db: Session, filters: ProductFilters, sort_by: SortCriteria | None = None, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE):
+    '''Reads one page of search results, returns its rows and the cursor of the next page.'''
     
-    products = [SearchProductResponse.from_orm(i) for i in db_products]
-    return products
+    query, relevance = filter_products(db, filters)
+    
+    if sort_by != None:
+        sort_keys, scope = SORT_KEYS[sort_by], sort_by.value
+    elif relevance is not None:
+        sort_keys, scope = [(relevance, False), (models.Product.id, False)], 'relevance'
+    else:
+        sort_keys, scope = [(models.Product.id, False)], 'id'
+    
+    return keyset_page(query.with_entities(*columns_of(SearchProductResponse, models.Product)), sort_keys, cursor, limit, scope=scope)
 
+# ------------------------------------------------------------------------------------------------------------------------------------
 
+# API Endpoint for searching and filtering products
+# Pages are read with keyset pagination: the next page is requested by passing back the X-Next-Cursor response header as cursor
 
+@router_search_filter.get('/products/', response_model=List[SearchProductResponse], response_class=SerializedJSONResponse)
+def get_products_search(filters: ProductFilters = Depends(), sort_by : SortCriteria | None = None, cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1), db : Session = Depends(get_read_db)):
+    db_products, next_cursor = search_page(db, filters, sort_by, cursor, limit)
+    
+    response = SerializedJSONResponse(dump_list(SearchProductResponse, db_products))
+    if next_cursor != None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    
+    return response
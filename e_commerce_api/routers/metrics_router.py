@@ -0,0 +1,32 @@
+'''Outbox queue depth, lag and delivery counters: GET /metrics/outbox
+Cache hits and misses: GET /metrics/cache'''
+
+from fastapi import APIRouter, Depends
+
+from e_commerce_api.cache import catalog_cache
+from e_commerce_api.database import SessionLocal, get_db
+from e_commerce_api.outbox import outbox_worker
+from e_commerce_api.routers.user_router import principal_cache
+
+router_metrics = APIRouter(
+    tags = ['Metrics Endpoints']
+)
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to get the state of the outbox: messages pending and given up on, age of the oldest pending one,
+# and what the worker of this process delivered so far
+
+@router_metrics.get('/metrics/outbox')
+def get_outbox_metrics(db : SessionLocal = Depends(get_db)): # type: ignore
+    return outbox_worker.metrics(db)
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to get the hits, misses and hit ratio of the caches of this process since it started
+
+@router_metrics.get('/metrics/cache')
+async def get_cache_metrics():
+    return {'catalog': catalog_cache.stats(), 'principals': principal_cache.stats()}
+
+# ------------------------------------------------------------------------------------------------------------------------------------
@@ -3,93 +3,139 @@
 from datetime import datetime
 from typing import Annotated, List
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from e_commerce_api.database import SessionLocal, get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from sqlalchemy import delete, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, load_only, selectinload
+from e_commerce_api.database import get_async_db, get_read_db, mark_written, read_session, written_at
 from e_commerce_api.routers.user_router import get_current_active_user
+from e_commerce_api.schemas.user_schema import Principal
 
-from e_commerce_api.schemas.order_schema import CreateOrder, Order # type: ignore
+from e_commerce_api.schemas.order_schema import CreateOrder, Order, OrderDetails # type: ignore
 from e_commerce_api import models
+from e_commerce_api.cache import invalidate_product
+from e_commerce_api.ordering import place_order
+from e_commerce_api.outbox import enqueue
+from e_commerce_api.sales import order_sale_lines, record_sales
+from e_commerce_api.pagination import DEFAULT_PAGE_SIZE, keyset_page
+from e_commerce_api.serialization import SerializedJSONResponse, dump_list
 
 router_order = APIRouter(
     tags = ['Order Endpoints']
 )
 
+# Sort keys of the order history pages, both follow ix_orders_user_id_order_date
+ALL_ORDERS_KEYS = [(models.Orders.user_id, False), (models.Orders.order_date, False), (models.Orders.id, False)]
+USER_ORDERS_KEYS = [(models.Orders.order_date, True), (models.Orders.id, True)]
+
+
+def get_user_read_db(request: Request, current_user: Annotated[Principal, Depends(get_current_active_user)]):
+    # The user's own orders: read from a replica, or from the primary for a while after they placed or cancelled one
+    with read_session(written_at(request, current_user.id)) as db:
+        yield db
+
+
+class OrderFilters:
+    def __init__(self, date_from: datetime | None = None, date_to: datetime | None = None, cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1)):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.cursor = cursor
+        self.limit = limit
+
+
+def _order_details(order) -> dict:
+    return {'id': order.id, 'user_id': order.user_id, 'order_date': order.order_date, 'total_quantity': order.order_quantity, 'total_price': order.total_price,
+            'items': [{'product_id': i.product_id, 'title': i.product.title if i.product != None else None, 'quantity': i.quantity, 'price': i.price, 'total_price': i.total_price}
+                      for i in order.order_product]}
+
+
+def read_order_page(db: Session, criteria: list, keys, filters: OrderFilters, scope: str):
+    '''Reads one page of the orders matching criteria and filters, returns the orders (with their lines) and the cursor of the next page.'''
+    
+    # Orders placed in [date_from, date_to)
+    if filters.date_from != None:
+        criteria = criteria + [models.Orders.order_date >= filters.date_from]
+    if filters.date_to != None:
+        criteria = criteria + [models.Orders.order_date < filters.date_to]
+    
+    # The lines of the whole page and then their products are loaded with one query each, three queries per page
+    query = db.query(models.Orders).filter(*criteria) \
+        .options(selectinload(models.Orders.order_product).selectinload(models.OrderItem.product).options(load_only(models.Product.id, models.Product.title)))
+    
+    orders, next_cursor = keyset_page(query, keys, filters.cursor, filters.limit, scope=scope)
+    return [_order_details(i) for i in orders], next_cursor
+
+
+def _order_page(db: Session, criteria: list, keys, filters: OrderFilters, scope: str) -> SerializedJSONResponse:
+    orders, next_cursor = read_order_page(db, criteria, keys, filters, scope)
+    
+    response = SerializedJSONResponse(dump_list(OrderDetails, orders))
+    if next_cursor != None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to create a new order
+# Placing and cancelling orders is async, orders are placed and rolled up by the same code as everywhere else (ordering.py, sales.py),
+# run on the request's async connection with run_sync. The order pages are read on the threadpool, where load_benchmark.py
+# serves them faster than through run_sync
 @router_order.post('/orders')
-def create_order(current_user: Annotated[models.User, Depends(get_current_active_user)],  order_details : CreateOrder, db : SessionLocal = Depends(get_db)): # type: ignore
+async def create_order(response: Response, current_user: Annotated[Principal, Depends(get_current_active_user)],  order_details : CreateOrder, db : AsyncSession = Depends(get_async_db)):
     db_user = current_user
 
    
     if len(order_details.products) == 0:
         raise HTTPException(status_code=200, detail="No products in order  ")
     
-    
     if db_user.is_seller == 1: # type: ignore
         raise HTTPException(status_code=200, detail="Seller cannot place orders")
-    else:
-        order_instance = models.Orders(user_id = db_user.id, order_date = datetime.now(), order_quantity = 0, total_price = 0)
-        db.add(order_instance)
-        db.commit()
-        db.refresh(order_instance)
-        order_quantity = 0
-        total_price = 0
-        for i in order_details.products:
-            if i.quantity < 1:
-                raise HTTPException(status_code=404, detail="Invalid quantity of products")
-            
-            else:
-                db_product = db.query(models.Product).filter(models.Product.id == i.product_id).first()
-                if db_product != None:
-                    if db_product.quantity_available < i.quantity:
-                        return HTTPException(status_code=400, detail="Not enough products available")
-                    if db_product.quantity_available == 0:
-                        raise HTTPException(status_code=400, detail="Product out of stock")
-                    else:
-                        try:
-                            order_item_instance = models.OrderItem(product_id = i.product_id, price = db_product.price,quantity = i.quantity, total_price = db_product.price * i.quantity, order_id = order_instance.id)
-                            order_quantity += i.quantity
-                            total_price += db_product.price * i.quantity
-                            db.add(order_item_instance)
-                            db_product.quantity_available -= i.quantity
-                            db.commit()
-                            db.refresh(db_product)
-                        except Exception as e:
-                            db.delete(order_instance)
-                            db.commit()
-                            raise HTTPException(status_code=400, detail=f"{e}")
-                            
-                else:
-                    db.delete(order_instance)
-                    db.commit()
-                    raise HTTPException(status_code=404, detail="Invalid Product ID")
-                            
-    order_instance.order_quantity = order_quantity # type: ignore
-    order_instance.total_price = total_price # type: ignore
-    if len(order_details.products) > 1:
-        db.delete(db.query(models.CartItem).filter(models.CartItem.cart_id == db_user.cart.id).all())
-    db.commit()
-    db.refresh(order_instance)
-    
-    raise HTTPException(status_code=200, detail="Order Placed Successfully")
-    
-    pass
+    
+    # Several lines of the same product are ordered as one
+    quantities = {}
+    for i in order_details.products:
+        if i.quantity < 1:
+            raise HTTPException(status_code=404, detail="Invalid quantity of products")
+        quantities[i.product_id] = quantities.get(i.product_id, 0) + i.quantity
+    
+    # One transaction: the stock, the order, its items and the cart are all written or none of them is
+    try:
+        await db.run_sync(place_order, db_user.id, quantities, cart_id=db_user.cart_id)
+        if db_user.cart_id != None:
+            await db.execute(delete(models.CartItem).where(models.CartItem.cart_id == db_user.cart_id, models.CartItem.product_id.in_(quantities))
+                             .execution_options(synchronize_session=False))
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"{e}")
+    
+    invalidate_product(*quantities)
+    mark_written(response, db_user.id)
+    
+    # Returned rather than raised (same body) so that the response keeps the cookie of mark_written
+    return {'detail': 'Order Placed Successfully'}
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get all orders
-@router_order.get('/order', response_model=List[Order])
-def get_all_orders(db : SessionLocal = Depends(get_db)): # type: ignore
-    return list(map(lambda i : Order(id=i.id, user_id=i.user_id, order_date=i.order_date, total_quantity=i.order_quantity, total_price=i.total_price), db.query(models.Orders).filter().all()))# type: ignore
+# Pages are read with keyset pagination: the next page is requested by passing back the X-Next-Cursor response header as cursor
+@router_order.get('/order', response_model=List[OrderDetails], response_class=SerializedJSONResponse)
+def get_all_orders(filters: OrderFilters = Depends(), db : Session = Depends(get_read_db)):
+    return _order_page(db, [], ALL_ORDERS_KEYS, filters, scope='orders')
     
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get a specific order
 @router_order.get('/orders/{order_id}', response_model=Order)
-def get_order(current_user: Annotated[models.User, Depends(get_current_active_user)],order_id: int, db : SessionLocal = Depends(get_db)):  # type: ignore
-    order_details = db.query(models.Orders).filter(models.Orders.id == order_id).first()
+def get_order(current_user: Annotated[Principal, Depends(get_current_active_user)],order_id: int, db : Session = Depends(get_user_read_db)):
+    order_details = db.execute(
+        select(models.Orders.id, models.Orders.user_id, models.Orders.order_date, models.Orders.order_quantity, models.Orders.total_price).where(models.Orders.id == order_id)
+    ).first()
+    
+    if order_details == None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Order does not exist'})
     
     if order_details.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
@@ -98,11 +144,12 @@ def get_order(current_user: Annotated[models.User, Depends(get_current_active_us
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
-# API Endpoint to get a specific order
+# API Endpoint to get the orders of the current user, newest first
+# Pages are read with keyset pagination: the next page is requested by passing back the X-Next-Cursor response header as cursor
 
-@router_order.get('/order-self', response_model=List[Order])
-def get_all_orders(current_user: Annotated[models.User, Depends(get_current_active_user)], db : SessionLocal = Depends(get_db)): # type: ignore
-    return list(map(lambda i : Order(id=i.id, user_id=i.user_id, order_date=i.order_date, total_quantity=i.order_quantity, total_price=i.total_price), db.query(models.Orders).filter(models.Orders.user_id == current_user.id).all()))# type: ignore
+@router_order.get('/order-self', response_model=List[OrderDetails], response_class=SerializedJSONResponse)
+def get_user_orders(current_user: Annotated[Principal, Depends(get_current_active_user)], filters: OrderFilters = Depends(), db : Session = Depends(get_user_read_db)):
+    return _order_page(db, [models.Orders.user_id == current_user.id], USER_ORDERS_KEYS, filters, scope=f'orders:{current_user.id}')
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
@@ -115,16 +162,28 @@ def get_all_orders(current_user: Annotated[models.User, Depends(get_current_acti
 
 # API Endpoint to cancel a specific order
 @router_order.delete('/orders/{order_id}')
-def cancel_order(current_user: Annotated[models.User, Depends(get_current_active_user)],order_id: int, db : SessionLocal = Depends(get_db)): # type: ignore
-    order_details = db.query(models.Orders).filter(models.Orders.id == order_id).first()
+async def cancel_order(response: Response, current_user: Annotated[Principal, Depends(get_current_active_user)],order_id: int, db : AsyncSession = Depends(get_async_db)):
+    order_details = (await db.execute(select(models.Orders.user_id, models.Orders.order_date).where(models.Orders.id == order_id))).first()
+    
+    if order_details == None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Order does not exist'})
     
     if order_details.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
     
-    db.delete(order_details)
-    db.commit()
+    # The lines with their sellers, taken away from the sales rollups in the same transaction as the order
+    lines = (await db.execute(order_sale_lines(order_id))).all()
     
-    raise HTTPException(status_code=200, detail="Order Cancelled Successfully")
-
-
-
+    try:
+        await db.run_sync(record_sales, order_details.order_date.date(), lines, sign=-1)
+        enqueue(db, 'order.cancelled', {'order_id': order_id, 'user_id': current_user.id}) # type: ignore
+        await db.execute(delete(models.OrderItem).where(models.OrderItem.order_id == order_id).execution_options(synchronize_session=False))
+        await db.execute(delete(models.Orders).where(models.Orders.id == order_id).execution_options(synchronize_session=False))
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"{e}")
+    
+    mark_written(response, current_user.id)
+    
+    return {'detail': 'Order Cancelled Successfully'}
@@ -1,45 +1,132 @@
+import csv
+import io
+import json
 from datetime import datetime
+from enum import Enum
 from typing import Annotated, List
-from fastapi import Depends, APIRouter, HTTPException, status
+from fastapi import Depends, APIRouter, HTTPException, Request, Response, UploadFile, status
+from fastapi.responses import StreamingResponse
+import pydantic
+from sqlalchemy import case, func, insert, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from e_commerce_api.database import SessionLocal, get_db
-from e_commerce_api.models import Product as product_model, User as user_model, WarehouseItem as warehouse_item_model, Warehouse as warehouse_model, Categories as category_model
+from e_commerce_api import search
+from e_commerce_api.cache import catalog_cache, invalidate_product
+from e_commerce_api.conditional import conditional_response, make_etag
+from e_commerce_api.database import SessionLocal, get_async_read_db, get_db, get_read_db
+from e_commerce_api.models import Product as product_model, WarehouseItem as warehouse_item_model, Categories as category_model
 
 from sqlalchemy.orm import Session
+from e_commerce_api.routers.filter_router import ProductFilters, filter_products
 from e_commerce_api.routers.user_router import get_current_active_user
+from e_commerce_api.schemas.user_schema import Principal
 
-from e_commerce_api.schemas.product_schema import ProductRequest, ProductResponse
+from e_commerce_api.serialization import SerializedJSONResponse, columns_of, dump_list
+from e_commerce_api.schemas.product_schema import BulkAdjustRequest, BulkAdjustResponse, BulkImportResponse, ImportRowError, ProductImportRow, ProductRequest, ProductResponse, SkippedAdjustment
 
 router_product = APIRouter(
     tags=['Product Endpoints']
 )
 
+# Products are cached as response models, ORM instances cannot outlive the session that loaded them
+def _product_response(product):
+    return ProductResponse.model_validate(product, from_attributes=True) if product != None else None
+
+# Cache entries for GET endpoints hold the body together with its conditional GET validators: (body, etag, last modified)
+def _representation(body, last_modified=None):
+    return body, make_etag(body), last_modified
+
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get all products
 
-@router_product.get('/products', response_model=List[ProductResponse])
-def get_products(db: SessionLocal = Depends(get_db), limit: int = 10): # type: ignore
-    products= db.query(product_model).order_by(product_model.created_at.desc()).limit(limit).all() # type: ignore
+@router_product.get('/products', response_model=List[ProductResponse], response_class=SerializedJSONResponse)
+async def get_products(request: Request, db: AsyncSession = Depends(get_async_read_db), limit: int = 10):
+    def load_products(db: Session):
+        rows = db.query(*columns_of(ProductResponse, product_model)).order_by(product_model.created_at.desc()).limit(limit).all() # type: ignore
+        # ETag only: no date of the rows on the page changes when a product is deleted, or added with an older last_edited
+        return _representation(dump_list(ProductResponse, rows))
+    
+    # The cache holds the serialized JSON, a hit is sent without touching pydantic (nor the database)
+    products, etag, last_modified = await db.run_sync(lambda db: catalog_cache.get_or_set(f'products:latest:{limit}', lambda: load_products(db), tags=['product:*']))
+    
+    response = SerializedJSONResponse(products)
+    not_modified = conditional_response(request, response, etag, last_modified)
+    if not_modified != None:
+        return not_modified
        
-    return products
+    return response
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to get all products created by a user
 
 @router_product.get('/products-self', response_model=List[ProductResponse])
-def get_products(current_user: Annotated[user_model, Depends(get_current_active_user)], db: SessionLocal = Depends(get_db), limit: int = 10): # type: ignore
+def get_products(current_user: Annotated[Principal, Depends(get_current_active_user)], db: SessionLocal = Depends(get_db), limit: int = 10): # type: ignore
     products= db.query(product_model).filter(product_model.owner_id==current_user.id).order_by(product_model.created_at.desc()).limit(limit).all()
        
     return products
     
 # ------------------------------------------------------------------------------------------------------------------------------------
 
+# API Endpoint to export the whole catalog
+# Rows are read EXPORT_CHUNK_SIZE at a time and written out as they arrive, so memory stays flat whatever the size of the catalog
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ['id', 'title', 'description', 'price', 'quantity_available', 'category', 'owner_id', 'created_at', 'last_edited']
+
+class ExportFormat(Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value != None and not isinstance(value, (int, str)):
+        return float(value)
+    return value
+
+def _export_chunks(rows, format: ExportFormat):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    if format == ExportFormat.csv:
+        writer.writerow(EXPORT_COLUMNS)
+    
+    for count, row in enumerate(rows, start=1):
+        values = [_export_value(i) for i in row]
+        if format == ExportFormat.csv:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values))) + '\n')
+        
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    yield buffer.getvalue()
+
+@router_product.get('/products/export', response_class=StreamingResponse)
+def export_products(filters: ProductFilters = Depends(), format: ExportFormat = ExportFormat.ndjson, db: SessionLocal = Depends(get_read_db)): # type: ignore
+    query, _ = filter_products(db, filters)
+    
+    # Plain column tuples instead of ORM instances, nothing is kept in the identity map while streaming
+    rows = query.with_entities(*[getattr(product_model, i) for i in EXPORT_COLUMNS]).order_by(product_model.id).yield_per(EXPORT_CHUNK_SIZE)
+    
+    return StreamingResponse(
+        _export_chunks(rows, format),
+        media_type='text/csv' if format == ExportFormat.csv else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="products.{format.value}"'},
+    )
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
 # API Endpoint to create a new product
 
 @router_product.post('/products', response_model=ProductResponse,)
-def create_product(current_user: Annotated[user_model, Depends(get_current_active_user)], product: ProductRequest, db: SessionLocal = Depends(get_db)): # type: ignore
+def create_product(current_user: Annotated[Principal, Depends(get_current_active_user)], product: ProductRequest, db: SessionLocal = Depends(get_db)): # type: ignore
     user = current_user
     category_exists = db.query(category_model).filter(category_model.category == product.category).first() != None
     
@@ -52,7 +139,6 @@ def create_product(current_user: Annotated[user_model, Depends(get_current_activ
     if  category_exists == False:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Category does not exist'})
 
-    warehouse_instance = db.query(warehouse_model).filter(warehouse_model.user_id == user.id).first()
     
     for key, value in product.dict(exclude_unset=True).items():
         if value == 0:
@@ -64,31 +150,200 @@ def create_product(current_user: Annotated[user_model, Depends(get_current_activ
     setattr(actual_db_product, 'created_at', datetime.now())
     setattr(actual_db_product, 'last_edited', datetime.now())
     db.add(actual_db_product)
-    db.commit()
-    db.refresh(actual_db_product)
-    warehouse_item = warehouse_item_model(warehouse_id=warehouse_instance.id, product_id=actual_db_product.id)
+    # Flushed for its id: the product, its search entry and its warehouse item are committed together
+    db.flush()
+    search.index_product(db, actual_db_product)
+    warehouse_item = warehouse_item_model(warehouse_id=user.warehouse_id, product_id=actual_db_product.id)
     db.add(warehouse_item)
     db.commit()
+    db.refresh(actual_db_product)
+    invalidate_product(actual_db_product.id)
     return actual_db_product
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
+# API Endpoint to create products in bulk from an XLSX or CSV file
+# The first row of the file is a header naming the columns: title, description, price, quantity_available, category
+
+IMPORT_CHUNK_SIZE = 500
+IMPORT_COLUMNS = ['title', 'description', 'price', 'quantity_available', 'category']
+
+def _read_import_rows(file: UploadFile, is_xlsx: bool):
+    # Yields (row number, {column: value}) one row at a time, the file is never loaded as a whole
+    if is_xlsx:
+        # Imported here, openpyxl alone takes a tenth of a second to import and only the imports use it
+        import openpyxl
+        workbook = openpyxl.load_workbook(file.file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(i).strip().lower() if i != None else '' for i in next(rows, ())]
+            for number, values in enumerate(rows, start=2):
+                if any(i != None for i in values):
+                    yield number, dict(zip(header, values))
+        finally:
+            workbook.close()
+    else:
+        reader = csv.DictReader(io.TextIOWrapper(file.file, encoding='utf-8-sig'))
+        reader.fieldnames = [i.strip().lower() for i in reader.fieldnames or []]
+        for values in reader:
+            # Blank rows are skipped as in a sheet, and numbered by their line in the file (DictReader already skips empty lines)
+            if any(str(i).strip() != '' for i in values.values() if i != None):
+                yield reader.line_num, values
+
+def _insert_import_chunk(db, chunk, owner_id: int, warehouse_id: int, errors: List[ImportRowError]) -> int:
+    # One transaction per chunk: a bulk INSERT of the products, then of their warehouse items and search entries
+    if len(chunk) == 0:
+        return 0
+    
+    now = datetime.now()
+    values = [dict(row.dict(), owner_id=owner_id, created_at=now, last_edited=now) for _, row in chunk]
+    
+    try:
+        product_ids = db.scalars(insert(product_model).returning(product_model.id, sort_by_parameter_order=True), values).all()
+        db.execute(insert(warehouse_item_model), [{'warehouse_id': warehouse_id, 'product_id': i} for i in product_ids])
+        search.index_new_products(db, [dict(value, id=i) for value, i in zip(values, product_ids)])
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        errors.extend(ImportRowError(row=number, message=f'Could not be stored: {e.__class__.__name__}') for number, _ in chunk)
+        return 0
+    
+    return len(product_ids)
+
+@router_product.post('/products/bulk', response_model=BulkImportResponse)
+def import_products(current_user: Annotated[Principal, Depends(get_current_active_user)], file: UploadFile, db: SessionLocal = Depends(get_db)): # type: ignore
+    if current_user.is_seller == False: # type: ignore
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User in not a seller'})
+    
+    filename = (file.filename or '').lower()
+    if not filename.endswith(('.xlsx', '.csv')):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Only .xlsx and .csv files can be imported'})
+    
+    if current_user.warehouse_id == None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'Warehouse does not exist'})
+    
+    categories = {i for (i,) in db.query(category_model.category).all()}
+    
+    created = 0
+    errors = []
+    chunk = []
+    
+    for number, values in _read_import_rows(file, is_xlsx=filename.endswith('.xlsx')):
+        try:
+            row = ProductImportRow(**{i: values.get(i) for i in IMPORT_COLUMNS})
+        except pydantic.ValidationError as e:
+            errors.append(ImportRowError(row=number, message='; '.join(f"{'.'.join(map(str, i['loc']))}: {i['msg']}" for i in e.errors())))
+            continue
+        
+        if row.category not in categories:
+            errors.append(ImportRowError(row=number, message=f'Category does not exist: {row.category}'))
+            continue
+        
+        chunk.append((number, row))
+        if len(chunk) == IMPORT_CHUNK_SIZE:
+            created += _insert_import_chunk(db, chunk, current_user.id, current_user.warehouse_id, errors)
+            chunk = []
+    
+    created += _insert_import_chunk(db, chunk, current_user.id, current_user.warehouse_id, errors)
+    
+    if created > 0:
+        invalidate_product()
+    
+    return BulkImportResponse(created=created, errors=errors)
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to change stock and/or price of many products at once
+# Ownership is checked with one query and the changes are applied with one UPDATE per kind of change, all in one transaction
+
+@router_product.patch('/products/bulk', response_model=BulkAdjustResponse)
+def adjust_products(current_user: Annotated[Principal, Depends(get_current_active_user)], details: BulkAdjustRequest, db: SessionLocal = Depends(get_db)): # type: ignore
+    skipped = {}
+    quantity_deltas = {}
+    prices = {}
+    
+    # Several changes to the same product add up (stock) or the last one wins (price)
+    for i in details.changes:
+        if i.quantity_delta == None and i.price == None:
+            skipped[i.product_id] = 'Nothing to change'
+            continue
+        if i.quantity_delta != None:
+            quantity_deltas[i.product_id] = quantity_deltas.get(i.product_id, 0) + i.quantity_delta
+        if i.price != None:
+            prices[i.product_id] = i.price
+    
+    requested_ids = set(quantity_deltas) | set(prices)
+    owned_ids = {i for (i,) in db.query(product_model.id).filter(product_model.id.in_(requested_ids), product_model.owner_id == current_user.id).all()} if requested_ids else set()
+    
+    for i in requested_ids - owned_ids:
+        skipped[i] = 'Product does not exist or is not owned by the user'
+    
+    quantity_deltas = {key: value for key, value in quantity_deltas.items() if key in owned_ids}
+    prices = {key: value for key, value in prices.items() if key in owned_ids}
+    updated_ids = set()
+    now = datetime.now()
+    
+    try:
+        if len(quantity_deltas) > 0:
+            new_quantity = func.coalesce(product_model.quantity_available, 0) + case(quantity_deltas, value=product_model.id)
+            # Stock cannot drop below the units carts hold (quantity_reserved is never negative, so nor below zero)
+            statement = update(product_model) \
+                .where(product_model.id.in_(quantity_deltas), new_quantity >= product_model.quantity_reserved) \
+                .values(quantity_available=new_quantity, last_edited=now) \
+                .returning(product_model.id) \
+                .execution_options(synchronize_session=False)
+            stock_updated_ids = set(db.scalars(statement).all())
+            
+            for i in set(quantity_deltas) - stock_updated_ids:
+                skipped[i] = 'Quantity available cannot go below zero or the units held in carts'
+                prices.pop(i, None)
+            updated_ids |= stock_updated_ids
+        
+        if len(prices) > 0:
+            statement = update(product_model) \
+                .where(product_model.id.in_(prices)) \
+                .values(price=case(prices, value=product_model.id), last_edited=now) \
+                .execution_options(synchronize_session=False)
+            db.execute(statement)
+            updated_ids |= set(prices)
+        
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': f'{e}'})
+    
+    if len(updated_ids) > 0:
+        invalidate_product(*updated_ids)
+    
+    return BulkAdjustResponse(updated=sorted(updated_ids), skipped=[SkippedAdjustment(product_id=key, reason=value) for key, value in skipped.items() if key not in updated_ids])
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
 # API Endpoint to get a specific product
 
 @router_product.get('/products/{product_id}', response_model=ProductResponse, name="Fetch a particular product")
-def get_product(current_user: Annotated[user_model, Depends(get_current_active_user)], product_id: int,db: SessionLocal = Depends(get_db)): # type: ignore
-    product_details = db.get(product_model, product_id)
-    if product_details.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+def get_product(request: Request, response: Response, current_user: Annotated[Principal, Depends(get_current_active_user)], product_id: int,db: SessionLocal = Depends(get_db)): # type: ignore
+    def load_product():
+        product = _product_response(db.get(product_model, product_id))
+        return _representation(product, product.last_edited if product != None else None)
+    
+    product_details, etag, last_modified = catalog_cache.get_or_set(f'product:{product_id}', load_product, tags=[f'product:{product_id}'])
     if product_details == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'product does not exist'})
+    if product_details.owner_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'User not authorized'})
+    
+    not_modified = conditional_response(request, response, etag, last_modified)
+    if not_modified != None:
+        return not_modified
+    
     return product_details
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to update a product
 @router_product.put('/products/{product_id}', response_model=ProductResponse)
-def update_product(current_user: Annotated[user_model, Depends(get_current_active_user)], product_id:int,product: ProductRequest, db: SessionLocal = Depends(get_db)): # type: ignore
+def update_product(current_user: Annotated[Principal, Depends(get_current_active_user)], product_id:int,product: ProductRequest, db: SessionLocal = Depends(get_db)): # type: ignore
     db_product = db.get(product_model,product_id)
     
     if db_product.owner_id != current_user.id:
@@ -107,10 +362,22 @@ def update_product(current_user: Annotated[user_model, Depends(get_current_activ
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Invalid input'})
         setattr(db_product, key,value)
     
+    # Checked in the UPDATE itself, so a hold taken since the product was read counts too
+    statement = update(product_model) \
+        .where(product_model.id == product_id, product_model.quantity_reserved <= product.quantity_available) \
+        .values(quantity_available=product.quantity_available) \
+        .returning(product_model.id) \
+        .execution_options(synchronize_session=False)
+    if db.execute(statement).first() == None:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={'message': 'Quantity available cannot go below the units held in carts'})
+    
     setattr(db_product, 'last_edited',datetime.now())
     db.add(db_product)
+    search.index_product(db, db_product)
     db.commit() 
     db.refresh(db_product)
+    invalidate_product(product_id)
     
     return db_product
 
@@ -120,7 +387,7 @@ def update_product(current_user: Annotated[user_model, Depends(get_current_activ
 
 # API Endpoint to delete a product
 @router_product.delete('/products/{product_id}')
-def delete_product(current_user: Annotated[user_model, Depends(get_current_active_user)], product_id: int, db:SessionLocal = Depends(get_db)): # type: ignore
+def delete_product(current_user: Annotated[Principal, Depends(get_current_active_user)], product_id: int, db:SessionLocal = Depends(get_db)): # type: ignore
     db_product = db.get(product_model, product_id)
     
     if db_product.owner_id != current_user.id:
@@ -129,7 +396,9 @@ def delete_product(current_user: Annotated[user_model, Depends(get_current_activ
     db_warehouse_item = db.query(warehouse_item_model).filter(warehouse_item_model.product_id == db_product.id).first()
     db.delete(db_warehouse_item)
     db.delete(db_product)
+    search.remove_product(db, product_id)
     db.commit()
+    invalidate_product(product_id)
     
     raise HTTPException(status_code=status.HTTP_200_OK, detail={'message': 'Product deleted successfully'})    
 
@@ -1,65 +1,69 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Annotated, List
 
-from e_commerce_api.secret_key import SECRET_KEY
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
-from e_commerce_api.database import get_db
-from e_commerce_api.models import User as user_model, Cart as cart_model, Warehouse as warehouse_model, Product as product_model, WarehouseItem as warehouse_item_model, CartItem as cart_item_model
-from e_commerce_api.schemas.user_schema import Token, TokenData, UserResponse, UserRegister, PasswordRequest
+from jose import JWTError
+from e_commerce_api.cache import Cache, MemoryBackend, MISSING, invalidate_product
+from e_commerce_api.database import get_async_db, get_db
+from e_commerce_api.models import User as user_model, Cart as cart_model, Warehouse as warehouse_model, Product as product_model, WarehouseItem as warehouse_item_model, CartItem as cart_item_model, RefreshToken as refresh_token_model
+from e_commerce_api.schemas.user_schema import Principal, RefreshRequest, Token, TokenData, UserResponse, UserRegister, PasswordRequest
 import re
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from e_commerce_api import search
+from e_commerce_api.reservations import release_holds
+from e_commerce_api.passwords import hash_password_async, verify_password_async, verify_and_update_async
+from e_commerce_api.tokens import create_access_token, decode_access_token, issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_user_refresh_tokens
 
-password_context = CryptContext(schemes=['bcrypt'],deprecated = 'auto')
-
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def hash_password(original_password) -> str:
-    return password_context.hash(original_password)
-
-def verify_password(original_password,hashed_password) -> bool:
-    return password_context.verify(original_password, hashed_password)
-
-# CREATES ACCESS TOKEN ----------------------------------------------------------
-
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
-# -------------------------------------------------------------------------------
+# Principals by token subject, tagged 'user:{id}' so that a change to the user drops it whatever its email was
+PRINCIPAL_CACHE_TTL = 30
+principal_cache = Cache(MemoryBackend(max_entries=10000), ttl=PRINCIPAL_CACHE_TTL)
 
 # GET USER USING PROVIDED TOKEN -----------------------------------------------------------------
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db : Session = Depends(get_db)):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db : AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub") # type: ignore
+        username: str = decode_access_token(token) # type: ignore
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(user_model).filter(user_model.email == token_data.username).first() 
-    if user is None:
-        raise credentials_exception
+    user = principal_cache.get(token_data.username) # type: ignore
+    if user is MISSING:
+        user = await load_principal(db, token_data.username) # type: ignore
+        if user is None:
+            raise credentials_exception
+        principal_cache.set(token_data.username, user, tags=[f'user:{user.id}']) # type: ignore
     return user
 
+async def load_principal(db: AsyncSession, email: str):
+    # Plain columns only: loading the User itself would also join every order, the cart and the warehouse (lazy="joined")
+    row = (await db.execute(
+        select(user_model.id, user_model.email, user_model.username, func.coalesce(user_model.is_seller, False).label('is_seller'), user_model.created_at,
+               cart_model.id.label('cart_id'), warehouse_model.id.label('warehouse_id'))
+        .outerjoin(cart_model, cart_model.user_id == user_model.id)
+        .outerjoin(warehouse_model, warehouse_model.user_id == user_model.id)
+        .where(user_model.email == email)
+    )).first()
+    return Principal.model_validate(row) if row != None else None
+
+def invalidate_principal(user_id: int):
+    principal_cache.invalidate(f'user:{user_id}')
+
 # -----------------------------------------------------------------------------------------------
 
 async def get_current_active_user(
-    current_user: Annotated[user_model, Depends(get_current_user)]
+    current_user: Annotated[Principal, Depends(get_current_user)]
 ):
     # if current_user.disabled:
     #     raise HTTPException(status_code=400, detail="Inactive user")
@@ -79,16 +83,15 @@ router_auth = APIRouter(
 # API Endpoint to register a new user
 
 @router_user.post("/users/register", response_model=UserResponse, name="Create a new user" )
-def create_user(user: UserRegister, db: Session = Depends(get_db)):
-    hashed_password = hash_password(user.password)
+async def create_user(user: UserRegister, db: AsyncSession = Depends(get_async_db)):
+    hashed_password = await hash_password_async(user.password)
     
     user_details = user_model(**user.dict())
     user_details.__setattr__('password', hashed_password)
     
     db.add(user_details)
-   
-    db.commit()
-    db.refresh(user_details)
+    # Flushed for its id, the user and its warehouse or cart are committed together
+    await db.flush()
     
     if user.is_seller:
         user_warehouse = warehouse_model(user_id=user_details.id)
@@ -97,8 +100,7 @@ def create_user(user: UserRegister, db: Session = Depends(get_db)):
         user_cart = cart_model(user_id=user_details.id)
         db.add(user_cart)
         
-    db.commit()
-    db.refresh(user_details)       
+    await db.commit()
     access_token = create_access_token(
         data={"sub": user_details.email}
     )
@@ -111,24 +113,64 @@ def create_user(user: UserRegister, db: Session = Depends(get_db)):
 # API Endpoint to let user login
 
 @router_auth.post("/token", response_model=Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),db: Session= Depends(get_db)):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     # user = authenticate_user(form_data.username, form_data.password,db)
     is_email = re.fullmatch(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b', form_data.username)
-    user = db.query(user_model).filter(user_model.email == form_data.username).first()if is_email else db.query(user_model).filter(user_model.username == form_data.username).first() 
-    print(user)
-    if not user:
-        user =  False
-    if not verify_password(form_data.password, user.password): # type: ignore
-        user = False
-    if not user:
+    login_column = user_model.email if is_email else user_model.username
+    user = (await db.execute(select(user_model.id, user_model.email, user_model.password).where(login_column == form_data.username))).first()
+    
+    is_valid, new_hash = await verify_and_update_async(form_data.password, user.password) if user else (False, None)
+    if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, # type: ignore
             detail="Incorrect username or password",
         )
+    
+    # The stored hash was made with another BCRYPT_ROUNDS, replace it now that the password is known
+    if new_hash != None:
+        await db.execute(update(user_model).where(user_model.id == user.id).values(password=new_hash)) # type: ignore
+    
+    refresh_token = issue_refresh_token(db, user.id) # type: ignore
+    await db.commit()
+    
     access_token = create_access_token(
         data={"sub": user.email}
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to get a new access token (and refresh token) without sending the password again
+
+@router_auth.post("/token/refresh", response_model=Token)
+def refresh_access_token(request: RefreshRequest, db: Session = Depends(get_db)):
+    user_id = rotate_refresh_token(db, request.refresh_token)
+    email = db.query(user_model.email).filter(user_model.id == user_id).scalar() if user_id != None else None
+    if email == None:
+        # Commits the revocations made on reuse of an already revoked token
+        db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+    
+    refresh_token = issue_refresh_token(db, user_id) # type: ignore
+    db.commit()
+    
+    access_token = create_access_token(
+        data={"sub": email}
+    )
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+# ------------------------------------------------------------------------------------------------------------------------------------
+
+# API Endpoint to log out, the refresh token can no longer be used
+
+@router_auth.post("/token/revoke")
+def revoke_token(request: RefreshRequest, db: Session = Depends(get_db)):
+    revoke_refresh_token(db, request.refresh_token)
+    db.commit()
+    return {'message': 'Refresh token revoked'}
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------
@@ -136,45 +178,50 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),db:
 # API Endpoint to update user data
 
 @router_user.put("/user",response_model=UserResponse, name="Update a user details with a particular id")
-def update_user(user: UserRegister, current_user: Annotated[user_model, Depends(get_current_active_user)], db: Session = Depends(get_db), ):
+def update_user(user: UserRegister, current_user: Annotated[Principal, Depends(get_current_active_user)], db: Session = Depends(get_db), ):
     
-    user = current_user
+    db_user = db.get(user_model, current_user.id)
     
-    if user == None:
+    if db_user == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'User does not exist'})
     
-    for key, value in user.dict(exclude_unset=True).items():
-        setattr(user, key,value)
+    # The password is only changed through /users/password, where it gets hashed
+    for key, value in user.dict(exclude_unset=True, exclude={'password'}).items():
+        setattr(db_user, key,value)
     
-    setattr(user, 'last_edited',datetime.now())
-    db.add(user)
+    setattr(db_user, 'last_edited',datetime.now())
+    db.add(db_user)
     db.commit() 
-    db.refresh(user)
+    db.refresh(db_user)
+    invalidate_principal(current_user.id)
     
-    return user
+    return db_user
 
 # ------------------------------------------------------------------------------------------------------------------------------------
 
 # API Endpoint to change user password
 
 @router_user.put("/users/password", name="Changes a users password with a particular id")
-def update_user_password(current_user: Annotated[user_model, Depends(get_current_active_user)],user: PasswordRequest, db: Session = Depends(get_db)):
+async def update_user_password(current_user: Annotated[Principal, Depends(get_current_active_user)],user: PasswordRequest, db: AsyncSession = Depends(get_async_db)):
     
-    user = current_user    
+    # The hash only, loading the User would also join its orders, cart and warehouse
+    password = (await db.execute(select(user_model.password).where(user_model.id == current_user.id))).scalar()
     
-    if user == None:
+    if password == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message': 'User does not exist'})
     
     user_request_dict = user.dict(exclude_unset=True)
     
-    if verify_password(user_request_dict['old_password'], user.password):
-        setattr(user, 'password',hash_password(user_request_dict['new_password']))
+    if await verify_password_async(user_request_dict['old_password'], password):
+        new_password = await hash_password_async(user_request_dict['new_password'])
+        await db.execute(update(user_model).where(user_model.id == current_user.id).values(password=new_password))
+        # Sessions started with the old password have to log in again
+        await db.run_sync(revoke_user_refresh_tokens, current_user.id)
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={'message': 'Password cannot be changed'})
             
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    invalidate_principal(current_user.id)
     
     raise HTTPException(status_code=status.HTTP_200_OK, detail={'message': 'Password successfully changed'})
 
@@ -183,7 +230,7 @@ def update_user_password(current_user: Annotated[user_model, Depends(get_current
 # API Endpoint to get a particular user's details
 
 @router_user.get("/user", response_model=UserResponse, name="Get details of a particular user")
-def get_user(current_user: Annotated[user_model, Depends(get_current_active_user)]):
+def get_user(current_user: Annotated[Principal, Depends(get_current_active_user)]):
     user_details = current_user
     if user_details == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message':'User does not exist'})
@@ -213,31 +260,43 @@ def get_all_users(limit: int = 10, db: Session = Depends(get_db)):
 # API Endpoint to delete user account
 
 @router_user.delete("/users/profile")
-def delete_user(current_user: Annotated[user_model, Depends(get_current_active_user)], db: Session = Depends(get_db)):
-    user = current_user
+def delete_user(current_user: Annotated[Principal, Depends(get_current_active_user)], db: Session = Depends(get_db)):
+    user = db.get(user_model, current_user.id)
     if user == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={'message':'User does not exist'})
     
+    deleted_product_ids = []
+    
     if user.is_seller: # type: ignore
-        user_warehouse = db.query(warehouse_model).filter().first()
-        user_warehouse_items = db.query(warehouse_item_model).filter(warehouse_item_model.warehouse_id == user_warehouse.id).all() # type: ignore
-        for i in user_warehouse_items:
-            db.delete(db.query(product_model).filter(product_model.id == i.product_id).first())
+        user_warehouse = db.get(warehouse_model, current_user.warehouse_id)
+        # The products with the rows the unit of work visits to delete them, one query per table instead of four per product
+        user_products = db.query(product_model) \
+            .join(warehouse_item_model, warehouse_item_model.product_id == product_model.id) \
+            .filter(warehouse_item_model.warehouse_id == user_warehouse.id) \
+            .options(selectinload(product_model.warehouse_items), selectinload(product_model.cart_items), selectinload(product_model.order_products)) \
+            .all() # type: ignore
+        for i in user_products:
+            deleted_product_ids.append(i.id)
+            for j in i.warehouse_items:
+                db.delete(j)
             db.delete(i)
             
         db.delete(user_warehouse)
+        search.remove_products(db, deleted_product_ids)
             
     else:
-        user_cart = db.query(cart_model).filter().first()
-        user_cart_items = db.query(cart_item_model).filter(cart_item_model.cart_id == user_cart.id).all() # type: ignore
-        
-        for i in user_cart_items:
-            db.delete(i)
+        user_cart = db.get(cart_model, current_user.cart_id)
+        db.query(cart_item_model).filter(cart_item_model.cart_id == user_cart.id).delete(synchronize_session=False) # type: ignore
         
+        # Deleting the cart would also delete its holds (ON DELETE CASCADE) without giving their units back
+        release_holds(db, user_cart.id) # type: ignore
         db.delete(user_cart)
-        
+    
+    db.query(refresh_token_model).filter(refresh_token_model.user_id == user.id).delete(synchronize_session=False)
     db.delete(user)
     db.commit()
+    invalidate_principal(current_user.id)
+    invalidate_product(*deleted_product_ids)
     raise HTTPException(status_code=status.HTTP_200_OK, detail={'message':'User successfully deleted'})
 
 # ------------------------------------------------------------------------------------------------------------------------------------
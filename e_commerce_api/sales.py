@@ -0,0 +1,134 @@
+'''
+sales.py keeps the per-seller sales rollups the analytics endpoints read.
+
+seller_daily_sales holds the orders, units and revenue of a seller per day and
+seller_product_daily_sales the units and revenue per product per day. Placing
+an order adds its lines to them and cancelling it takes them away again, in the
+order's own transaction, with one upsert per table: a dashboard then reads a
+few rows per day instead of scanning the order history.
+
+A line counts for the seller recorded with it when it was ordered
+(OrderItem.seller_id), so the sales of a product deleted since stay with its
+seller both here and in a rebuild.
+
+The rollups can always be rebuilt from orders and order items, for instance
+after a bulk import or a schema change: `python manage.py rebuild-sales-rollups`.
+
+'''
+
+from collections import defaultdict
+from datetime import date
+from typing import Iterable, List, Tuple
+
+from sqlalchemy import Date, cast, delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from e_commerce_api.database import upsert_insert
+from e_commerce_api.models import OrderItem, Orders, Product, SellerDailySales, SellerProductDailySales
+
+# (product id, seller id, quantity, total price)
+SaleLine = Tuple[int, int, float, float]
+
+
+def _add_to(db: Session, table, keys: List[str], rows: List[dict]) -> None:
+    # Adds the counters of rows to the existing rows (or inserts them) in one statement
+    if len(rows) == 0:
+        return
+    counters = [i for i in rows[0] if i not in keys]
+    dialect = db.get_bind().dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        statement = upsert_insert(db.get_bind())(table).values(rows)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={i: getattr(table, i) + getattr(statement.excluded, i) for i in counters},
+        ))
+        return
+
+    # No upsert for this database: update what exists, insert the rest
+    for row in rows:
+        result = db.execute(update(table)
+                            .where(*[getattr(table, i) == row[i] for i in keys])
+                            .values({i: getattr(table, i) + row[i] for i in counters}))
+        if result.rowcount == 0:
+            db.execute(insert(table).values(row))
+
+
+def record_sales(db: Session, day: date, lines: Iterable[SaleLine], sign: int = 1) -> None:
+    '''Adds the lines of one order to the rollups of day, or takes them away with sign=-1 when it is cancelled.'''
+
+    sellers = defaultdict(lambda: [0, 0])
+    products = defaultdict(lambda: [0, 0])
+    for product_id, seller_id, quantity, total_price in lines:
+        for counters in (sellers[seller_id], products[(seller_id, product_id)]):
+            counters[0] += quantity
+            counters[1] += total_price
+
+    _add_to(db, SellerDailySales, ['seller_id', 'day'], [
+        {'seller_id': seller_id, 'day': day, 'orders': sign, 'units': sign * units, 'revenue': sign * revenue}
+        for seller_id, (units, revenue) in sellers.items()
+    ])
+    _add_to(db, SellerProductDailySales, ['seller_id', 'day', 'product_id'], [
+        {'seller_id': seller_id, 'day': day, 'product_id': product_id, 'units': sign * units, 'revenue': sign * revenue}
+        for (seller_id, product_id), (units, revenue) in products.items()
+    ])
+
+
+# The seller a line is rolled up for: the one recorded with the line, or for lines older than that column its product's owner
+_line_seller = func.coalesce(OrderItem.seller_id, Product.owner_id)
+
+
+def _order_day(db: Session):
+    # SQLite has no DATE type, date() gives the same 'YYYY-MM-DD' the Date column stores
+    return func.date(Orders.order_date) if db.get_bind().dialect.name == 'sqlite' else cast(Orders.order_date, Date)
+
+
+def order_sale_lines(order_id: int):
+    '''Selects the SaleLines of an order, as rebuild_sales_rollups counts them (lines without a seller are left out).'''
+
+    return select(OrderItem.product_id, _line_seller, OrderItem.quantity, OrderItem.total_price) \
+        .outerjoin(Product, Product.id == OrderItem.product_id) \
+        .where(OrderItem.order_id == order_id, _line_seller != None)
+
+
+def backfill_order_sellers(db: Session) -> int:
+    '''
+    Records the seller of the order lines that have none: their product's owner, or for a product deleted since the
+    seller its rollup row of the order's day was counted for. Returns the number of lines updated.
+    '''
+
+    owner = select(Product.owner_id).where(Product.id == OrderItem.product_id).scalar_subquery()
+    rolled_up_for = select(SellerProductDailySales.seller_id) \
+        .join(Orders, Orders.id == OrderItem.order_id) \
+        .where(SellerProductDailySales.product_id == OrderItem.product_id, SellerProductDailySales.day == _order_day(db)) \
+        .limit(1) \
+        .scalar_subquery()
+    return db.execute(update(OrderItem).where(OrderItem.seller_id == None).values(seller_id=func.coalesce(owner, rolled_up_for))
+                      .execution_options(synchronize_session=False)).rowcount
+
+
+def rebuild_sales_rollups(db: Session) -> int:
+    '''Recomputes both rollups from the orders. Returns the number of seller days.'''
+
+    # Read from the rollups about to be replaced, for the lines of deleted products that have no seller yet
+    backfill_order_sellers(db)
+
+    lines = select(_line_seller.label('owner_id'), _order_day(db).label('day'), OrderItem.product_id, OrderItem.order_id, OrderItem.quantity, OrderItem.total_price) \
+        .join(Orders, Orders.id == OrderItem.order_id) \
+        .outerjoin(Product, Product.id == OrderItem.product_id) \
+        .where(_line_seller != None) \
+        .subquery()
+
+    db.execute(delete(SellerProductDailySales))
+    db.execute(delete(SellerDailySales))
+
+    db.execute(insert(SellerProductDailySales).from_select(
+        ['seller_id', 'day', 'product_id', 'units', 'revenue'],
+        select(lines.c.owner_id, lines.c.day, lines.c.product_id, func.sum(lines.c.quantity), func.sum(lines.c.total_price))
+        .group_by(lines.c.owner_id, lines.c.day, lines.c.product_id),
+    ))
+    return db.execute(insert(SellerDailySales).from_select(
+        ['seller_id', 'day', 'orders', 'units', 'revenue'],
+        select(lines.c.owner_id, lines.c.day, func.count(lines.c.order_id.distinct()), func.sum(lines.c.quantity), func.sum(lines.c.total_price))
+        .group_by(lines.c.owner_id, lines.c.day),
+    )).rowcount
@@ -0,0 +1,21 @@
+from datetime import date
+from typing import Optional
+from pydantic import BaseModel, ConfigDict
+
+
+class DailySales(BaseModel):
+    day : date
+    orders : int
+    units : float
+    revenue : float
+    
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ProductSales(BaseModel):
+    product_id : int
+    title : Optional[str] = None
+    units : float
+    revenue : float
+    
+    model_config = ConfigDict(from_attributes=True)
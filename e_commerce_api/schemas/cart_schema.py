@@ -1,5 +1,5 @@
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 
 class AddProductRequest(BaseModel):
@@ -21,14 +21,14 @@ class CartProductResponse(BaseModel):
     price : float
     quantity_available : int
     category : str
+    line_total : float = 0
        
-    class config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class CartResponse(BaseModel):
     id : int
     user_id : int
     products : List[CartProductResponse] = []
+    subtotal : float = 0
     
-    class config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
@@ -1,16 +1,19 @@
 
-from pydantic import BaseModel
+from typing import Optional
+from pydantic import BaseModel, ConfigDict
 
 
 
 class SearchProductResponse(BaseModel):
     id : int
-    title : str
+    # products.title is nullable
+    title : Optional[str] = None
     description : str
     owner_id: int
     price : float
     quantity_available : int
+    # Stock not held by carts
+    available_to_sell : int
     category : str
     
-    class Config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
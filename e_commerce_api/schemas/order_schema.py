@@ -1,6 +1,6 @@
 from datetime import datetime
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional
 
     
 class OrderProduct(BaseModel):
@@ -19,6 +19,20 @@ class Order(BaseModel):
     total_quantity : int
     total_price : float
     
-    class config:
-        orm_mode = True
-    
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+    
+
+
+class OrderLine(BaseModel):
+    product_id : int
+    title : Optional[str] = None
+    quantity : int
+    price : float
+    total_price : float
+    
+    model_config = ConfigDict(from_attributes=True)
+
+
+# An order of the order history, with its lines
+class OrderDetails(Order):
+    items : List[OrderLine] = []
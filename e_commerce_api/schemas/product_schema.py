@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
         
 class ProductRequest(BaseModel):
@@ -11,8 +11,7 @@ class ProductRequest(BaseModel):
     category: str
     owner_id:int
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
         
 class UserResponse(BaseModel):
     id: int
@@ -20,12 +19,11 @@ class UserResponse(BaseModel):
     username: Optional[str] = None
     created_at: datetime 
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
         
 class ProductResponse(BaseModel):
     id: int
-    title: str
+    title: Optional[str] = None
     description: str
     price: float
     quantity_available: float
@@ -34,16 +32,14 @@ class ProductResponse(BaseModel):
     created_at: datetime
     last_edited: datetime
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
         
 class Warehouse(BaseModel):
     # total_value: int
     products: List[ProductResponse]
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class SingleOrderRequest(BaseModel):
@@ -55,8 +51,7 @@ class SingleOrderRequest(BaseModel):
     
     
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class OrderRequest(BaseModel):
@@ -64,8 +59,7 @@ class OrderRequest(BaseModel):
     amount_paid:int
     orders: List[SingleOrderRequest]
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class ItemRequest(BaseModel):
     title: str
@@ -75,7 +69,42 @@ class ItemRequest(BaseModel):
     category: str
     
     
-    class Config:
-        orm_mode = True
-        
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ProductImportRow(BaseModel):
+    title: str
+    description: str
+    price: float = Field(gt=0)
+    quantity_available: float = Field(gt=0)
+    category: str
+
+
+class ImportRowError(BaseModel):
+    row: int
+    message: str
+
+
+class BulkImportResponse(BaseModel):
+    created: int
+    errors: List[ImportRowError] = []
+
+
+class ProductAdjustment(BaseModel):
+    product_id: int
+    quantity_delta: Optional[float] = None
+    price: Optional[float] = Field(None, gt=0)
+
+
+class BulkAdjustRequest(BaseModel):
+    changes: List[ProductAdjustment]
+
+
+class SkippedAdjustment(BaseModel):
+    product_id: int
+    reason: str
+
 
+class BulkAdjustResponse(BaseModel):
+    updated: List[int] = []
+    skipped: List[SkippedAdjustment] = []
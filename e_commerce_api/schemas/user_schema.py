@@ -1,11 +1,15 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
     
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -17,24 +21,21 @@ class UserRegister(BaseModel):
     email: str
     password: str
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
         
 class UserLogin(BaseModel):
     username: Optional[str] = None
     password: str
     email: str
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
     
 class UserUpdate(BaseModel):
     email: Optional[str] = None
     username: Optional[str] = None
     
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class PasswordRequest(BaseModel):
     email: str
@@ -49,8 +50,7 @@ class OrderProducts(BaseModel):
     price: int
     total_price: int
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
     
 
 # User Response for Getting users
@@ -61,8 +61,21 @@ class UserResponse(BaseModel):
     is_seller: bool
     created_at: datetime
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class SellerResponse(UserResponse):
-    warehouse_id: int
\ No newline at end of file
+    warehouse_id: int
+
+
+# The authenticated user handed to endpoints by get_current_user, it is cached per token subject
+# so it only holds plain columns, endpoints needing relationships load the User themselves
+class Principal(BaseModel):
+    id: int
+    email: str
+    username: Optional[str] = None
+    is_seller: bool
+    created_at: datetime
+    cart_id: Optional[int] = None
+    warehouse_id: Optional[int] = None
+    
+    model_config = ConfigDict(from_attributes=True, frozen=True)
@@ -0,0 +1,129 @@
+'''
+search.py keeps the full-text index used by the keyword search endpoint.
+
+SQLite: an FTS5 table (products_fts) holds a copy of every product's title and
+description keyed by the product id. product_router writes to it on the
+create/update/delete paths, inside the same transaction as the product itself.
+
+Postgres: no shadow table is needed, a GIN index over the product tsvector is
+queried directly and kept up to date by Postgres.
+
+'''
+
+from typing import List
+
+from sqlalchemy import Float, Integer, bindparam, func, inspect, literal_column, or_, text
+from sqlalchemy.orm import Query, Session
+
+from e_commerce_api.models import Product
+
+FTS_TABLE = 'products_fts'
+TS_CONFIG = 'english'
+
+# The query has to use exactly the indexed expression for Postgres to pick the GIN index
+TS_DOCUMENT = f"to_tsvector('{TS_CONFIG}', coalesce(products.title, '') || ' ' || products.description)"
+
+
+def _dialect(bind) -> str:
+    return bind.dialect.name
+
+
+def _fts_match_expression(keyword: str) -> str:
+    # Every word is quoted so FTS5 operators in user input are matched literally,
+    # and prefix matched so "appl" still finds "Apples" like the old LIKE search did
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in keyword.split())
+
+
+# CREATES THE INDEX ----------------------------------------------------------------
+
+def create_search_index(engine) -> None:
+    '''Creates the full-text index if missing. A newly created SQLite index is filled from the products table.'''
+
+    with engine.begin() as connection:
+        if _dialect(connection) == 'sqlite':
+            exists = inspect(connection).has_table(FTS_TABLE)
+            connection.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(title, description, tokenize='porter unicode61')"))
+            if not exists:
+                _fill_sqlite_index(connection)
+        elif _dialect(connection) == 'postgresql':
+            connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_products_search ON products USING GIN (({TS_DOCUMENT}))'))
+
+
+def _fill_sqlite_index(connection) -> int:
+    connection.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    result = connection.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, title, description) SELECT id, coalesce(title, ''), description FROM products"))
+    return result.rowcount
+
+
+def rebuild_search_index(db: Session) -> int:
+    '''Re-indexes every existing product. Returns the number of products indexed.'''
+
+    if _dialect(db.get_bind()) == 'sqlite':
+        return _fill_sqlite_index(db)
+    if _dialect(db.get_bind()) == 'postgresql':
+        db.execute(text('REINDEX INDEX ix_products_search'))
+    return db.query(Product).count()
+
+# -----------------------------------------------------------------------------------
+
+# KEEPS THE INDEX IN SYNC WITH PRODUCTS ---------------------------------------------
+
+def index_product(db: Session, product: Product) -> None:
+    if _dialect(db.get_bind()) != 'sqlite':
+        return
+    db.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'), {'id': product.id})
+    db.execute(text(f'INSERT INTO {FTS_TABLE} (rowid, title, description) VALUES (:id, :title, :description)'),
+               {'id': product.id, 'title': product.title or '', 'description': product.description})
+
+
+def index_new_products(db: Session, products: List[dict]) -> None:
+    '''Indexes freshly inserted products (dicts with id, title and description) with one statement.'''
+
+    if _dialect(db.get_bind()) != 'sqlite' or len(products) == 0:
+        return
+    # A row left behind for a reused id (SQLite hands out the ids of deleted rows again) would make the INSERT fail
+    remove_products(db, [i['id'] for i in products])
+    db.execute(text(f'INSERT INTO {FTS_TABLE} (rowid, title, description) VALUES (:id, :title, :description)'),
+               [{'id': i['id'], 'title': i['title'] or '', 'description': i['description']} for i in products])
+
+
+def remove_product(db: Session, product_id: int) -> None:
+    remove_products(db, [product_id])
+
+
+def remove_products(db: Session, product_ids: List[int]) -> None:
+    if _dialect(db.get_bind()) != 'sqlite' or len(product_ids) == 0:
+        return
+    db.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid IN :ids').bindparams(bindparam('ids', expanding=True)), {'ids': list(product_ids)})
+
+# -----------------------------------------------------------------------------------
+
+# RUNS A KEYWORD SEARCH -------------------------------------------------------------
+
+def match_products(db: Session, query: Query, keyword: str):
+    '''
+    Restricts a Product query to the products matching keyword.
+    Returns the filtered query and a relevance expression, best matches sort first in ascending order.
+    '''
+
+    dialect = _dialect(db.get_bind())
+
+    if not keyword.split():
+        return query, Product.id
+
+    if dialect == 'sqlite':
+        matches = text(f'SELECT rowid AS product_id, bm25({FTS_TABLE}) AS rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match') \
+            .bindparams(match=_fts_match_expression(keyword)) \
+            .columns(product_id=Integer, rank=Float) \
+            .subquery('fts_matches')
+        return query.join(matches, matches.c.product_id == Product.id), matches.c.rank
+
+    if dialect == 'postgresql':
+        document = literal_column(TS_DOCUMENT)
+        ts_query = func.plainto_tsquery(TS_CONFIG, keyword)
+        return query.filter(document.op('@@')(ts_query)), -func.ts_rank(document, ts_query)
+
+    # No full-text support for this database, fall back to an unranked substring match
+    return query.filter(or_(Product.title.contains(keyword), Product.description.contains(keyword))), Product.id
+
+# -----------------------------------------------------------------------------------
@@ -0,0 +1,42 @@
+'''
+serialization.py is the fast path for list responses.
+
+Instead of loading ORM instances and building one response model per row, list
+endpoints select just the columns of the response (labelled like its fields)
+and hand the rows to a cached TypeAdapter: pydantic-core validates the whole
+List[...] in one call and writes the JSON bytes itself. The bytes are sent as
+they are by SerializedJSONResponse, FastAPI does not validate or encode them
+a second time.
+
+'''
+
+from functools import lru_cache
+from typing import Any, Iterable, List, Type
+
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+
+
+class SerializedJSONResponse(Response):
+    '''JSON response for a body that is already serialized.'''
+
+    media_type = 'application/json'
+
+
+@lru_cache(maxsize=None)
+def list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    # Building an adapter compiles a validator and a serializer, it is done once per model
+    return TypeAdapter(List[model])
+
+
+def dump_list(model: Type[BaseModel], rows: Iterable[Any]) -> bytes:
+    '''JSON array of model built from rows, rows only need attributes named like the fields (ORM instances, Row tuples...).'''
+
+    adapter = list_adapter(model)
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+
+def columns_of(model: Type[BaseModel], entity, **renamed) -> list:
+    '''The columns of entity selected for each field of model, renamed maps a field to a differently named column.'''
+
+    return [renamed[i].label(i) if i in renamed else getattr(entity, i) for i in model.model_fields]
@@ -0,0 +1,188 @@
+'''
+tokens.py issues and checks the tokens clients authenticate with.
+
+Access tokens are short-lived JWTs sent with every request. Verifying one with
+python-jose (base64, JSON and an HMAC) on every request adds up, so a verified
+token is remembered by VerifiedTokenCache until its exp claim: checking it again
+is then a dictionary lookup. Access tokens are not revocable, they expire.
+
+Refresh tokens are opaque random strings stored (hashed) in refresh_tokens.
+A client trades one for a new access token instead of sending the password
+again, which would cost a bcrypt hash. Every refresh rotates the token: the
+presented one is revoked and a new one is handed out. A revoked token coming
+back means it was copied, every refresh token of that user is then revoked.
+
+'''
+
+import hashlib
+import heapq
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from e_commerce_api.models import RefreshToken
+from e_commerce_api.secret_key import SECRET_KEY
+
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = 14
+
+
+# ACCESS TOKENS ---------------------------------------------------------------------
+
+# jose.jwt is imported when first used: it loads every key backend (RSA, EC) and would add them to each worker's startup
+
+def create_access_token(data: dict):
+    from jose import jwt
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+
+class VerifiedTokenCache:
+    '''
+    Subjects of already verified tokens, by token. Bounded: once full, expired tokens are
+    dropped first and only then the least recently used ones.
+    '''
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()  # token -> (expires_at, subject)
+        self._expiry: list = []  # heap of (expires_at, token), may hold tokens already evicted
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry != None and entry[0] > time.time():
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[1]
+            if entry != None:
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def set(self, token: str, subject: str, expires_at: float) -> None:
+        with self._lock:
+            self._entries[token] = (expires_at, subject)
+            self._entries.move_to_end(token)
+            heapq.heappush(self._expiry, (expires_at, token))
+            if len(self._entries) > self.max_entries:
+                self._drop_expired()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            # Heap entries of tokens evicted as least recently used are only popped once expired, rebuild before it grows unbounded
+            if len(self._expiry) > 2 * self.max_entries:
+                self._expiry = [(entry[0], token) for token, entry in self._entries.items()]
+                heapq.heapify(self._expiry)
+
+    def _drop_expired(self) -> None:
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, token = heapq.heappop(self._expiry)
+            entry = self._entries.get(token)
+            if entry != None and entry[0] == expires_at:
+                del self._entries[token]
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+verified_tokens = VerifiedTokenCache(max_entries=10000)
+
+
+def decode_access_token(token: str) -> Optional[str]:
+    '''Subject (email) of a valid access token. Raises JWTError for an invalid or expired one.'''
+
+    subject = verified_tokens.get(token)
+    if subject != None:
+        return subject
+
+    from jose import jwt
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    subject = payload.get("sub")
+    # Tokens without an expiry are not remembered, create_access_token always sets one
+    if subject != None and payload.get("exp") != None:
+        verified_tokens.set(token, subject, float(payload["exp"]))
+    return subject
+
+# -----------------------------------------------------------------------------------
+
+# REFRESH TOKENS --------------------------------------------------------------------
+
+def _hash_token(token: str) -> str:
+    # The token is 256 random bits, a plain (fast) hash is enough to keep the table useless to a reader
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_refresh_token(db: Session, user_id: int) -> str:
+    '''Adds a new refresh token of user_id to the session (the caller commits) and returns it.'''
+
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(user_id=user_id, token_hash=_hash_token(token),
+                        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)))
+    return token
+
+
+def rotate_refresh_token(db: Session, token: str) -> Optional[int]:
+    '''
+    Revokes a refresh token and returns the id of its user, who can then be issued a new one.
+    Returns None when the token is unknown, expired or already revoked.
+    '''
+
+    now = datetime.utcnow()
+    token_hash = _hash_token(token)
+
+    # Checked and revoked in one statement, two requests racing with the same token cannot both succeed
+    user_id = db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.token_hash == token_hash, RefreshToken.revoked_at == None, RefreshToken.expires_at > now)
+        .values(revoked_at=now)
+        .returning(RefreshToken.user_id)
+    ).scalar()
+
+    if user_id == None:
+        reused = db.query(RefreshToken.user_id).filter(RefreshToken.token_hash == token_hash, RefreshToken.revoked_at != None).scalar()
+        if reused != None:
+            revoke_user_refresh_tokens(db, reused)
+
+    return user_id
+
+
+def revoke_refresh_token(db: Session, token: str) -> None:
+    db.execute(update(RefreshToken)
+               .where(RefreshToken.token_hash == _hash_token(token), RefreshToken.revoked_at == None)
+               .values(revoked_at=datetime.utcnow()))
+
+
+def revoke_user_refresh_tokens(db: Session, user_id: int) -> None:
+    db.execute(update(RefreshToken)
+               .where(RefreshToken.user_id == user_id, RefreshToken.revoked_at == None)
+               .values(revoked_at=datetime.utcnow()))
+
+
+def purge_refresh_tokens(db: Session) -> int:
+    '''Deletes expired refresh tokens, revoked ones included. Returns the number deleted.'''
+
+    return db.query(RefreshToken).filter(RefreshToken.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+
+# -----------------------------------------------------------------------------------
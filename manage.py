@@ -0,0 +1,207 @@
+'''
+Maintenance commands for the database behind the API.
+
+Usage: python manage.py <command>
+'''
+
+import argparse
+
+from sqlalchemy import inspect, text
+
+from e_commerce_api import database, models, passwords, reservations, sales, search, tokens
+
+DEMO_CATEGORIES = ['fruits', 'vegetables', 'dairy', 'meat', 'seafood', 'beverages', 'snacks', 'canned', 'frozen', 'baking', 'household', 'personal care', 'other']
+
+
+def create_schema(args):
+    # Everything a new database needs, safe to run again on an existing one (e.g. before every deployment)
+    create_indexes(args)
+    search.create_search_index(database.engine)
+
+    print('schema ready')
+
+
+def seed_demo_data(args):
+    # Adds whatever is missing of the demo categories, seller (with two products) and buyer, running it again changes nothing
+    db = database.SessionLocal()
+    try:
+        existing = {i for (i,) in db.query(models.Categories.category).all()}
+        db.add_all([models.Categories(category=i) for i in DEMO_CATEGORIES if i not in existing])
+
+        if db.query(models.User.id).filter(models.User.email == 'bhadrakshb@gmail.com').first() == None:
+            seller = models.User(username='flashbad', email='bhadrakshb@gmail.com', password=passwords.hash_password('testing123'), is_seller=1)
+            db.add(seller)
+            db.flush()
+            warehouse = models.Warehouse(user_id=seller.id)
+            products = [models.Product(title='Apples', description='Juicy Apples', price=10, quantity_available=1000, category='fruits', owner_id=seller.id),
+                        models.Product(title='Oranges', description='Sweet Oranges', price=50, quantity_available=5000, category='fruits', owner_id=seller.id)]
+            db.add_all([warehouse, *products])
+            db.flush()
+            db.add_all([models.WarehouseItem(product_id=i.id, warehouse_id=warehouse.id) for i in products])
+            for i in products:
+                search.index_product(db, i)
+
+        if db.query(models.User.id).filter(models.User.email == 'divyanshisnotjacked@gmail.com').first() == None:
+            buyer = models.User(username='divyanshisnotjacked', email='divyanshisnotjacked@gmail.com', password=passwords.hash_password('testing123'))
+            db.add(buyer)
+            db.flush()
+            db.add(models.Cart(user_id=buyer.id))
+
+        db.commit()
+    finally:
+        db.close()
+
+    print('demo data ready')
+
+
+def create_indexes(args):
+    # create_all only creates missing tables, indexes added to an existing table have to be created separately
+    models.Base.metadata.create_all(bind=database.engine)
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=database.engine, checkfirst=True)
+
+    print('indexes up to date')
+
+
+def rebuild_search_index(args):
+    search.create_search_index(database.engine)
+
+    db = database.SessionLocal()
+    try:
+        indexed = search.rebuild_search_index(db)
+        db.commit()
+    finally:
+        db.close()
+
+    print(f'indexed {indexed} products')
+
+
+def migrate_cart_items(args):
+    # Merges the lines of a product added to a cart several times into its first line, then adds the unique
+    # index on (cart_id, product_id) the cart endpoints upsert against
+    with database.engine.begin() as connection:
+        merged = connection.execute(text(
+            'UPDATE cart_items SET quantity = (SELECT SUM(duplicate.quantity) FROM cart_items duplicate '
+            'WHERE duplicate.cart_id = cart_items.cart_id AND duplicate.product_id = cart_items.product_id) '
+            'WHERE id IN (SELECT MIN(id) FROM cart_items GROUP BY cart_id, product_id HAVING COUNT(*) > 1)'
+        )).rowcount
+        deleted = connection.execute(text(
+            'DELETE FROM cart_items WHERE id NOT IN (SELECT MIN(id) FROM cart_items GROUP BY cart_id, product_id)'
+        )).rowcount
+
+        for index in models.CartItem.__table__.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+    print(f'merged {deleted} duplicate cart lines into {merged} lines')
+
+
+def migrate_stock_holds(args):
+    # Adds the reserved counter to an existing products table and the stock_holds table, then recounts the counter
+    if 'quantity_reserved' not in [i['name'] for i in inspect(database.engine).get_columns('products')]:
+        with database.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE products ADD COLUMN quantity_reserved DECIMAL NOT NULL DEFAULT 0'))
+    models.Base.metadata.create_all(bind=database.engine)
+
+    db = database.SessionLocal()
+    try:
+        reservations.recount_reserved(db)
+        db.commit()
+    finally:
+        db.close()
+
+    print('stock holds ready')
+
+
+def normalize_product_timestamps(args):
+    # Products stamped by SQLite's CURRENT_TIMESTAMP hold 'YYYY-MM-DD HH:MM:SS', the app writes (and pagination cursors
+    # bind) 'YYYY-MM-DD HH:MM:SS.ffffff': the short values never compare equal to a cursor and `sort_by=latest` keeps
+    # repeating a page. Other databases store real timestamps, there is nothing to do
+    if database.engine.dialect.name != 'sqlite':
+        print('product timestamps are stored as timestamps, nothing to normalize')
+        return
+
+    with database.engine.begin() as connection:
+        normalized = 0
+        for column in ('created_at', 'last_edited'):
+            normalized += connection.execute(text(
+                f"UPDATE products SET {column} = {column} || '.000000' WHERE length({column}) = 19"
+            )).rowcount
+
+    print(f'normalized {normalized} product timestamps')
+
+
+def release_expired_holds(args):
+    released = reservations.sweep_expired_holds(database.SessionLocal)
+
+    print(f'released {released} expired stock holds')
+
+
+def _add_order_item_seller_column():
+    if 'seller_id' not in [i['name'] for i in inspect(database.engine).get_columns('order_items')]:
+        with database.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE order_items ADD COLUMN seller_id INTEGER'))
+
+
+def migrate_order_sellers(args):
+    # Adds the seller recorded with each order line to an existing order_items table and fills it in for the existing lines
+    models.Base.metadata.create_all(bind=database.engine)
+    _add_order_item_seller_column()
+
+    db = database.SessionLocal()
+    try:
+        updated = sales.backfill_order_sellers(db)
+        db.commit()
+    finally:
+        db.close()
+
+    print(f'recorded the seller of {updated} order lines')
+
+
+def rebuild_sales_rollups(args):
+    models.Base.metadata.create_all(bind=database.engine)
+    _add_order_item_seller_column()
+
+    db = database.SessionLocal()
+    try:
+        seller_days = sales.rebuild_sales_rollups(db)
+        db.commit()
+    finally:
+        db.close()
+
+    print(f'rebuilt sales rollups, {seller_days} seller days')
+
+
+def purge_refresh_tokens(args):
+    db = database.SessionLocal()
+    try:
+        purged = tokens.purge_refresh_tokens(db)
+        db.commit()
+    finally:
+        db.close()
+
+    print(f'purged {purged} expired refresh tokens')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='E-Commerce API maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('create-schema', help='create the tables, indexes and search index of a new database').set_defaults(func=create_schema)
+    commands.add_parser('seed-demo-data', help='add the demo categories, seller, buyer and products').set_defaults(func=seed_demo_data)
+    commands.add_parser('create-indexes', help='create tables and indexes missing from the database').set_defaults(func=create_indexes)
+    commands.add_parser('rebuild-search-index', help='re-index every product for keyword search').set_defaults(func=rebuild_search_index)
+    commands.add_parser('migrate-cart-items', help='merge duplicate cart lines and add the unique (cart_id, product_id) index').set_defaults(func=migrate_cart_items)
+    commands.add_parser('migrate-stock-holds', help='add stock reservations to an existing database').set_defaults(func=migrate_stock_holds)
+    commands.add_parser('normalize-product-timestamps', help='store every product timestamp with microseconds, as the app writes them').set_defaults(func=normalize_product_timestamps)
+    commands.add_parser('release-expired-holds', help='give back the stock held by expired cart holds').set_defaults(func=release_expired_holds)
+    commands.add_parser('migrate-order-sellers', help='record the seller of each existing order line, as new orders do').set_defaults(func=migrate_order_sellers)
+    commands.add_parser('rebuild-sales-rollups', help='recompute the sellers\' sales rollups from the orders').set_defaults(func=rebuild_sales_rollups)
+    commands.add_parser('purge-refresh-tokens', help='delete expired refresh tokens').set_defaults(func=purge_refresh_tokens)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()